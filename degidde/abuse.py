@@ -0,0 +1,195 @@
+import array
+import hashlib
+import struct
+import threading
+import time
+
+from .models import conf
+from .utils import bump_generation
+
+
+WINDOW = conf.get('ABUSE_WINDOW', 600)
+MERGE_INTERVAL = conf.get('ABUSE_MERGE_INTERVAL', 10)
+IP_LIMIT = conf.get('ABUSE_IP_LIMIT', 50) # failures per window
+USER_LIMIT = conf.get('ABUSE_USER_LIMIT', 20)
+SKETCH_WIDTH = conf.get('ABUSE_SKETCH_WIDTH', 4096)
+SKETCH_DEPTH = conf.get('ABUSE_SKETCH_DEPTH', 4)
+HEAVY_HITTERS = conf.get('ABUSE_HEAVY_HITTERS', 32)
+TRUSTED_PROXIES = conf.get('ABUSE_TRUSTED_PROXIES', 0) # own proxies adding to X-Forwarded-For
+
+
+class CountMinSketch(object):
+    # Fixed size counts that never underestimate. Hashes are derived from
+    # md5, not hash(), so sketches built by different processes can be merged.
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.counts = array.array('I', [0]) * (width * depth)
+
+    def _cells(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [i * self.width + (h1 + i * h2) % self.width for i in range(self.depth)]
+
+    def add(self, key, n=1):
+        counts = self.counts
+        cells = self._cells(key)
+        for c in cells:
+            counts[c] += n
+        return min(counts[c] for c in cells)
+
+    def estimate(self, key):
+        counts = self.counts
+        return min(counts[c] for c in self._cells(key))
+
+    def merge(self, other):
+        counts = self.counts
+        for i, n in enumerate(other.counts):
+            if n:
+                counts[i] += n
+        return self
+
+
+class AbuseTracker(object):
+    '''
+    Counts events per key over fixed windows. Each process counts into a
+    local sketch and, at most every `merge_interval` seconds, writes what it
+    counted in the window to its own slot in the cache, so recording an
+    event costs no cache write and no two processes write the same key.
+    The window's count is the sum of all slots. Estimates add the previous
+    window's count, weighted by how much of it still overlaps a sliding
+    window.
+    '''
+    def __init__(self, name, window=WINDOW, merge_interval=MERGE_INTERVAL,
+                 heavy_hitters=HEAVY_HITTERS):
+        self.cache_key = __name__ + ':' + name + ':'
+        self.window = window
+        self.merge_interval = merge_interval
+        self.heavy_hitters = heavy_hitters
+        self.heavy = {} # the keys with the highest estimates in this window
+        self._lock = threading.Lock()
+        self._current = None
+        self._local = CountMinSketch()
+        self._merged = CountMinSketch()
+        self._prev = CountMinSketch()
+        self._merged_at = 0
+        self._pending = 0
+        self._own = CountMinSketch() # this process' count in the window
+        self._slot = None
+
+    def _merge(self, now):
+        from django.core.cache import cache
+
+        key = self.cache_key + str(self._current)
+        timeout = 2 * self.window
+        if self._pending:
+            if self._slot is None:
+                self._slot = bump_generation(key + ':slots', timeout)
+            self._own.merge(self._local)
+            cache.set('%s:%d' % (key, self._slot), self._own, timeout)
+            self._local = CountMinSketch()
+            self._pending = 0
+        slots = cache.get(key + ':slots') or 0
+        shared = CountMinSketch()
+        for sketch in cache.get_many(['%s:%d' % (key, i)
+                                      for i in range(1, slots + 1)]).values():
+            shared.merge(sketch)
+        self._merged = shared
+        self._merged_at = now
+
+    def _update(self, now):
+        # Must hold the lock.
+        current = int(now // self.window)
+        if current != self._current:
+            self._prev = CountMinSketch()
+            if self._current is not None:
+                self._merge(now)
+                if current == self._current + 1:
+                    self._prev = self._merged
+            self._current = current
+            self._own = CountMinSketch()
+            self._slot = None
+            self._merge(now)
+            self.heavy.clear()
+        elif now - self._merged_at >= self.merge_interval:
+            self._merge(now)
+
+    def _estimate(self, key, now):
+        overlap = 1 - (now % self.window) / float(self.window)
+        return (self._merged.estimate(key) + self._local.estimate(key)
+                + int(self._prev.estimate(key) * overlap))
+
+    def record(self, key, n=1):
+        now = time.time()
+        with self._lock:
+            self._update(now)
+            self._local.add(key, n)
+            self._pending += n
+            estimate = self._estimate(key, now)
+            heavy = self.heavy
+            if key in heavy or len(heavy) < self.heavy_hitters:
+                heavy[key] = estimate
+            else:
+                lightest = min(heavy, key=heavy.get)
+                if heavy[lightest] < estimate:
+                    del heavy[lightest]
+                    heavy[key] = estimate
+        return estimate
+
+    def estimate(self, key):
+        now = time.time()
+        with self._lock:
+            self._update(now)
+            return self._estimate(key, now)
+
+    def top(self):
+        with self._lock:
+            return sorted(self.heavy.items(), key=lambda kv: -kv[1])
+
+
+failures = AbuseTracker('failures')
+
+_client = threading.local()
+
+
+def trusted_addr(request, proxies=TRUSTED_PROXIES):
+    '''
+    The client's address, as seen by the outermost of our own proxies.
+    Each proxy appends the address it was connected from to
+    X-Forwarded-For, so only the last `proxies` entries can be trusted;
+    anything before them is whatever the client sent.
+    '''
+    if proxies:
+        forwarded = [a.strip() for a in
+                     request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if a.strip()]
+        if len(forwarded) >= proxies:
+            return forwarded[-proxies]
+    return request.META.get('REMOTE_ADDR')
+
+
+def set_client_addr(addr):
+    _client.addr = addr
+
+
+def client_addr():
+    return getattr(_client, 'addr', None)
+
+
+def login_failed(username, ip=None):
+    ip = ip or client_addr()
+    failures.record(u'user:' + username)
+    if ip:
+        failures.record(u'ip:' + ip)
+
+
+def bad_session(ip=None):
+    ip = ip or client_addr()
+    if ip:
+        failures.record(u'ip:' + ip)
+
+
+def locked_out(username=None, ip=None):
+    ip = ip or client_addr()
+    return bool((ip and failures.estimate(u'ip:' + ip) >= IP_LIMIT)
+                or (username and failures.estimate(u'user:' + username) >= USER_LIMIT))
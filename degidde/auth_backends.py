@@ -1,10 +1,14 @@
 
+from . import abuse, hashers
 from .models import User, ExternalUser, Permission
+from .permissions import table as perm_table, GroupWatch
 from .utils import ExpireDict
 
 
-# In process cache, with 1 day expiration
-_group_perms_cache = ExpireDict(86400)         # 24 * 60 * 60
+# In process cache of group permission masks, with 1 day expiration.
+# Writes from other instances are picked up through the watch.
+_group_perms_cache = ExpireDict(timeout=86400)         # 24 * 60 * 60
+_group_watch = GroupWatch()
 
 
 class ModelBackend(object):
@@ -14,25 +18,71 @@ class ModelBackend(object):
         '''
         Here username can also be the user's email address.
         '''
+        if abuse.locked_out(username):
+            return
         if u'@' in username:
             u = self.user_cls.fetch_by_email(username)
             if u and not u.is_validated:
                 u = None
         else:
             u = User.fetch(username)
-        if u and u.check_password(password):
-            return u
+        try:
+            valid = u and hashers.run(u.check_password, password)
+        except hashers.Busy:
+            return # fail closed, but this is no evidence of abuse
+        if not valid:
+            abuse.login_failed(username)
+            return
+        if hashers.must_update(u.password):
+            # Upgrade hashes made with older settings, now that the password
+            # is known. If busy, the next login will.
+            try:
+                hashers.run(u.set_password, password)
+            except hashers.Busy:
+                return u
+            u.save()
+        return u
 
     def get_user(self, user_id):
         return self.user_cls.fetch(user_id)
 
-    def get_group_permissions(self, user_obj):
+    def get_group_mask(self, user_obj):
         group = user_obj.group
-        if group not in _group_perms_cache:
+        _group_watch.check(_group_perms_cache)
+        mask = _group_perms_cache.get(group)
+        if mask is None:
             # This must be as idempotent as possible!
-            perms = frozenset(p.perm for p in Permission.fetch_by_group(user_obj.group))
-            _group_perms_cache[group] = perms
-        return _group_perms_cache[group]
+            gen = _group_watch.generation(group)
+            mask = perm_table.mask(p.perm for p in Permission.fetch_by_group(group) or ()
+                                   if p.perm in perm_table.bits)
+            _group_perms_cache[group] = mask
+            _group_watch.built(group, gen)
+        return mask
+
+    def get_group_permissions(self, user_obj):
+        return perm_table.names(self.get_group_mask(user_obj))
+
+    def get_user_mask(self, user_obj):
+        # All of a user's permissions come from one key range scan, and are
+        # kept on the user object for the rest of the request.
+        mask = getattr(user_obj, '_perm_mask', None)
+        if mask is None:
+            mask = perm_table.mask(p.perm for p in Permission.fetch(user_obj.username)
+                                   if p.perm in perm_table.bits)
+            user_obj._perm_mask = mask
+        return mask
+
+    def get_user_permissions(self, user_obj):
+        return perm_table.names(self.get_user_mask(user_obj))
+
+    def get_all_permissions(self, user_obj):
+        return perm_table.names(self.get_group_mask(user_obj) | self.get_user_mask(user_obj))
+
+    def has_mask(self, user_obj, mask):
+        group = self.get_group_mask(user_obj)
+        if not mask & ~group:
+            return True
+        return not mask & ~(group | self.get_user_mask(user_obj))
 
     def has_perm(self, user_obj, perm):
         # Faster for users that have the permission.
@@ -40,18 +90,12 @@ class ModelBackend(object):
         # ensuring the connexion is secure and, that
         # the user has logged in with a password, is
         # also required. Use a decorator for this.
+        bit = perm_table.bit(perm)
+        return bool(bit) and self.has_mask(user_obj, bit)
 
-        r = perm in self.get_group_permissions(user_obj)
-        if r:
-            return True
-        if not hasattr(user_obj, '_perm_cache'):
-            user_obj._perm_cache = set()
-        if perm in user_obj._perm_cache:
-            return True
-        if Permission.fetch(user_obj.username, perm):
-            user_obj._perm_cache.add(perm)
-            return True
-        return False
+    def has_perms(self, user_obj, perms):
+        mask = perm_table.mask(perms)
+        return mask is not None and self.has_mask(user_obj, mask)
 
 
 class ExternalUserBackend(ModelBackend):
@@ -0,0 +1,183 @@
+import hashlib
+import math
+import struct
+import threading
+import time
+
+from .models import conf, User
+
+
+CAPACITY = conf.get('AVAILABILITY_CAPACITY', 100000) # usernames plus emails
+ERROR_RATE = conf.get('AVAILABILITY_ERROR_RATE', 0.01)
+REFRESH_INTERVAL = conf.get('AVAILABILITY_REFRESH_INTERVAL', 60)
+TIMEOUT = conf.get('AVAILABILITY_TIMEOUT', 2 * 86400) # rebuild more often than this
+
+
+class BloomFilter(object):
+    # Hashes are derived from md5, like abuse.CountMinSketch, so filters
+    # built by different processes agree and can be merged.
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for p in self._positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def merge(self, other):
+        bits = self.bits
+        for i, b in enumerate(other.bits):
+            if b:
+                bits[i] |= b
+        self.count = max(self.count, other.count)
+        return self
+
+    @property
+    def false_positive_rate(self):
+        # From the fraction of bits set, which holds however many keys
+        # were added, even if some of them were added twice.
+        filled = sum(bin(b).count('1') for b in self.bits) / float(self.size)
+        return filled ** self.hashes
+
+
+class AvailabilityIndex(object):
+    '''
+    Bloom filter of taken usernames and emails, shared through the cache.
+    Only a possible hit needs the datastore lookup. Without a filter, e.g.
+    before the first rebuild, everything is a possible hit.
+
+    A miss is only a hint: users saved elsewhere than the signup form, or
+    added by other processes since the last refresh, may not be in the
+    filter yet. Anything that must not create a duplicate still looks up.
+    '''
+    def __init__(self, name='taken', capacity=CAPACITY, error_rate=ERROR_RATE,
+                 refresh_interval=REFRESH_INTERVAL):
+        self.cache_key = __name__ + ':' + name
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.refresh_interval = refresh_interval
+        self.filter = None
+        self.rebuild_stats = None
+        self.checks = 0
+        self.skipped = 0 # checks answered without the datastore
+        self._lock = threading.Lock()
+        self._loaded_at = 0
+
+    def _refresh(self):
+        from django.core.cache import cache
+
+        now = time.time()
+        if now - self._loaded_at < self.refresh_interval:
+            return
+        self._loaded_at = now
+        shared = cache.get(self.cache_key)
+        if shared is not None:
+            self.filter, self.rebuild_stats = shared
+
+    def may_be_taken(self, kind, value):
+        with self._lock:
+            self._refresh()
+            self.checks += 1
+            if self.filter is None or kind + u':' + value in self.filter:
+                return True
+            self.skipped += 1
+            return False
+
+    def add(self, **values):
+        '''
+        Adds new values, e.g. add(username=..., email=...), to the local
+        filter and the shared one. Concurrent adds from other processes
+        may be lost from the shared filter until the next rebuild.
+        '''
+        from django.core.cache import cache
+
+        keys = [kind + u':' + v for kind, v in values.items() if v]
+        with self._lock:
+            self._refresh()
+            if self.filter is None:
+                return
+            for key in keys:
+                self.filter.add(key)
+            shared = cache.get(self.cache_key)
+            if shared is not None:
+                self.filter.merge(shared[0])
+            cache.set(self.cache_key, (self.filter, self.rebuild_stats), TIMEOUT)
+
+    def rebuild(self, lock_timeout=600):
+        '''
+        Builds a new filter from all users and shares it. Returns what the
+        rebuild cost, or None if another one is in progress.
+        '''
+        from django.core.cache import cache
+
+        lock = self.cache_key + ':lock'
+        if not cache.add(lock, 1, lock_timeout):
+            return
+        try:
+            start = time.time()
+            f = BloomFilter(self.capacity, self.error_rate)
+            users = 0
+            for user in User.fetch_all():
+                f.add(u'username:' + user.username)
+                if user.email:
+                    f.add(u'email:' + user.email.lower())
+                users += 1
+            stats = {
+                'users': users,
+                'seconds': time.time() - start,
+                'bytes': len(f.bits),
+                'rebuilt_at': time.time(),
+            }
+            cache.set(self.cache_key, (f, stats), TIMEOUT)
+            with self._lock:
+                self.filter, self.rebuild_stats = f, stats
+                self._loaded_at = time.time()
+            return stats
+        finally:
+            cache.delete(lock)
+
+    @property
+    def stats(self):
+        with self._lock:
+            self._refresh()
+            f = self.filter
+            r = dict(self.rebuild_stats or {})
+            r.update({
+                'checks': self.checks,
+                'skipped': self.skipped,
+                'entries': f and f.count or 0,
+                'capacity': self.capacity,
+                'false_positive_rate': f and f.false_positive_rate,
+            })
+            return r
+
+
+taken = AvailabilityIndex()
+
+
+def username_may_be_taken(username):
+    return taken.may_be_taken(u'username', username.lower())
+
+
+def email_may_be_taken(email):
+    return taken.may_be_taken(u'email', email.lower())
+
+
+def user_added(user):
+    taken.add(username=user.username, email=user.email and user.email.lower())
@@ -1,18 +1,27 @@
 from google.appengine.ext import db
 
 from degidde.models import *
+from degidde.utils import Future
 
 
-def _insert(obj, id):
+_no_retries = db.create_transaction_options(retries=0)
+
+
+def _insert(obj):
+    # The datastore has no conditional put, so this is the cheapest atomic
+    # insert: a get by key (bypassing any cache) and a put committed in the
+    # same transaction. Contention is retried here, with backoff, instead of
+    # by run_in_transaction's immediate retries.
+    key = obj.key()
     def txn():
-        if not obj.fetch(id):
+        if db.get(key) is None:
             obj.put()
             return obj
 
-    if self.is_saved():
+    if obj.is_saved():
         return
-    if self._session_key:
-        return db.run_in_transaction(txn)
+    return retry(lambda: db.run_in_transaction_options(_no_retries, txn),
+                 db.TransactionFailedError, INSERT_RETRIES, INSERT_BACKOFF)
 
 
 def dump(obj,):
@@ -31,9 +40,24 @@ def dump(obj,):
         return key_name
 
 
+class Model(db.Model):
+    # What the shared model code needs beyond db.Model, as in the sqlite
+    # backend.
+    @classmethod
+    def get_by_key_name_async(cls, key_name):
+        return Future(db.get_async(db.Key.from_path(cls.kind(), key_name)).get_result)
+
+    @classmethod
+    def delete_by_key_name(cls, key_name):
+        db.delete(db.Key.from_path(cls.kind(), key_name))
+
+    def _put_async(self):
+        return Future(db.put_async(self).get_result)
+
+
 class Session(db.Model):
     session_data = db.BlobProperty(required=True)
-    expire_date = db.DateTimeProperty(required=True, indexed=False)
+    expire_date = db.DateTimeProperty(required=True) # indexed for purge_expired
 
     def __init__(self, *args, **kwargs):
         key = kwargs.pop('session_key', None)
@@ -56,26 +80,67 @@ class Session(db.Model):
         #    return expires_after < obj.expire_date and obj or None
         return obj
 
+    @classmethod
+    def fetch_many(cls, session_keys):
+        return cls.get_by_key_name(list(session_keys))
+
     @classmethod
     def remove(cls, session_key):
         db.delete(db.Key.from_path(cls.kind(), session_key))
 
     def save(self, force_insert=False):
         if force_insert and self._session_key:
-            return _insert(self, self._session_key)
+            return _insert(self)
         self.put()
         return self
 
+    @classmethod
+    def _expired(cls, now=None):
+        return cls.all(keys_only=True).filter('expire_date <', now or datetime.datetime.now())
 
-class Permission(db.Model):
+    @classmethod
+    def purge_expired(cls, batch_size=500, cursor=None, now=None):
+        '''
+        Deletes one batch of expired sessions.
+        Returns (deleted, cursor to resume from, whether more may remain).
+        '''
+        query = cls._expired(now)
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(batch_size)
+        if keys:
+            db.delete(keys)
+        return len(keys), query.cursor(), len(keys) == batch_size
+
+    @classmethod
+    def purge_unindexed(cls, batch_size=500, cursor=None, now=None):
+        '''
+        Like purge_expired, for sessions saved before expire_date was
+        indexed: scans all the keys and checks the sessions themselves.
+        Sessions still valid are left alone; run it again once they can
+        have expired, until it no longer deletes any.
+        '''
+        query = cls.all(keys_only=True)
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(batch_size)
+        now = now or datetime.datetime.now()
+        expired = [s.key() for s in db.get(keys) if s and s.expire_date < now]
+        if expired:
+            db.delete(expired)
+        return len(expired), query.cursor(), len(keys) == batch_size
+
+    @classmethod
+    def count_expired(cls, limit=1000, now=None):
+        return cls._expired(now).count(limit)
+
+
+class Permission(Model, PermissionBase):
     # This properties will all be cached!
     granted_by = db.StringProperty(required=True)
     date_granted = db.DateTimeProperty(auto_now_add=True)
     #expires = db.DateTime...
 
-    _group_pre = u'@'
-    _perm_pre = u'/'
-
     def __init__(self, *args, **kwargs):
         # group must be one of the predefined groups in settings,
         # same applies to perm.
@@ -92,69 +157,32 @@ class Permission(db.Model):
             super(Permission, self).__init__(key_name = key, *args, **kwargs)
         else:
             super(Permission, self).__init__(*args, **kwargs)
-            self.username, self.group, self.perm = self.parse_key_name()
+            self.username, self.group, self.perm = self.parse_key_name(self.key().name())
+
+    # db.Model's save and remove, aliases of put and delete, come first
+    # in the MRO, so the shared ones are bound here.
+    save = PermissionBase.__dict__['save']
+    remove = PermissionBase.__dict__['remove']
 
     @classmethod
-    def _make_key_name(cls, username, group, perm):
-        if group:
-            start = cls._group_pre + group
-        else:
-            start = username # There must be a username
-        return start + cls._perm_pre + (perm or '')
-    
+    def _prefix_query(cls, key, keys_only=False):
+        return cls.all(keys_only=keys_only).filter(
+            '__key__ >', db.Key.from_path(cls.kind(), key)
+        ).filter(
+            '__key__ <', db.Key.from_path(cls.kind(), key + u'\ufffd')
+        )
+
     @classmethod
-    def parse_key_name(cls, key_name):
-        start, perm = key_name.split(self._perm_pre, 1)
-        username = group = None
-        if start.startswith(cls._group_pre):
-            group = start[1:]
-        else:
-            username = start
-        return username, group, perm or None
- 
-    _cache_key = lambda cls, group, perm: not perm and group
-    @cache(_cache_key, namespace='Permission')
-    def fetch_by_group(cls, group, perm=None):
-        return cls.fetch(None, perm, _group=group)
-
-    save = fetch_by_group.invalidate(lambda self: self.group)(db.Model.put)
-
-    @fetch_by_group.invalidate(_cache_key)
-    def remove_by_group(cls, group, perm=None):
-        return cls.remove(None, perm, _group=group)
-
-    fetch_by_group = classmethod(fetch_by_group)
-    remove_by_group = classmethod(remove_by_group)
-
-    def remove(cls, username, perm=None, _group=None):
-        if not (username or _group):
-            return
-        key = cls._make_key_name(username, _group, perm)
-        if perm:
-            db.delete(db.Key(cls.kind(), key))
-        else:
-            db.delete(list(cls.all(keys_only=True).filter(
-                '__key__ >', db.Key.from_path(cls.kind(), key)
-            ).filter(
-                '__key__ <', db.Key.from_path(cls.kind(), key + u'\ufffd')
-            )))
-        
+    def _remove_prefix(cls, key):
+        db.delete(list(cls._prefix_query(key, keys_only=True)))
+
     @classmethod
-    def fetch(cls, username, perm=None, _group=None):
-        if not (username or _group):
-            return ()
-        key = cls._make_key_name(username, _group, perm)
-        if perm:
-            return cls.get_by_key_name(key)
-        else:
-            return cls.all().filter(
-                '__key__ >', db.Key.from_path(cls.kind(), key)
-            ).filter(
-                '__key__ <', db.Key.from_path(cls.kind(), key + u'\ufffd')
-            )
+    def _list_async(cls, query):
+        results = query.run() # starts the first batch
+        return Future(lambda: list(results))
 
 
-class User(db.Model, UserBase):
+class User(Model, UserBase):
     csusername = db.StringProperty(indexed=False) # Case sensitive username
     full_name = db.StringProperty(indexed=False)
     email = db.EmailProperty(required=True)
@@ -181,59 +209,79 @@ class User(db.Model, UserBase):
             return self.key().name() #Assumes that a key will always have a name
         return self._username
 
-    def fetch(cls, username):
-        return cls.get_by_key_name(username)
+    # As for Permission, over db.Model's save and remove.
+    save = UserBase.__dict__['save']
+    remove = UserBase.__dict__['remove']
 
-    def remove(cls, username):
-        db.delete(db.Key.from_path(cls.kind(), username))
-    
-    def save(self, force_insert=False):
-        if force_insert and self._username:
-            return _insert(self, self._username)
-        self.put()
-        return self
+    def _insert(self):
+        return _insert(self)
+
+    # Inserts stay synchronous, they need a transaction.
+    def _insert_async(self):
+        return Future(result=self._insert())
 
-    if USER_CACHE_TIMEOUT:
-        _cache_key = lambda cls, username: username
-        fetch = cache(_cache_key, timeout=USER_CACHE_TIMEOUT, namespace='User')(fetch)
-        save = fetch.invalidate(lambda self: self.username)(save)
-        remove = fetch.invalidate(_cache_key)(remove)
-    fetch = classmethod(fetch)
-    remove = classmethod(remove)
- 
     @classmethod
-    def fetch_by_email(cls, email, first=True):
-        query = cls.all().filter('email', email).order('date_validated')
-        if first:
-            return query.get()
-        return query #reconsider!
+    def _by_email(cls, email):
+        return cls.all().filter('email', email).order('date_validated')
 
     @classmethod
-    def fetch_by_alias(cls, alias):
-        obj = cls.all().filter('aliased_to', alias).get()
-        if obj:
-            return obj
+    def _first_async(cls, query):
+        results = query.run(limit=1)
+        return Future(lambda: next(results, None))
 
-        alias = UserAlias.get_by_key_name(alias)
-        if alias:
-            return cls.fetch(alias.username)
+    @classmethod
+    def _commit_aliases(cls, aliases):
+        db.put([UserAlias(key_name=alias, username=username)
+                for username, alias in aliases.items()])
+        users = [u for u in cls.get_by_key_name(list(aliases))
+                 if u and u.aliased_to == aliases[u.username]]
+        for user in users:
+            user.aliased_to = None
+        if users:
+            db.put(users)
 
-    def save_alias(self, alias):
-        UserAlias(key_name=alias, username=self.username).put()
+    @classmethod
+    def migrate_aliases(cls, batch_size=500, cursor=None):
+        '''
+        Moves one batch of aliases from aliased_to to UserAlias.
+        Returns (migrated, cursor to resume from, whether more may remain).
+        '''
+        query = cls.all().filter('aliased_to >', u'').order('aliased_to')
+        if cursor:
+            query.with_cursor(cursor)
+        users = query.fetch(batch_size)
+        for user in users:
+            # Alias first, so an interrupted batch can just be run again.
+            user.save_alias(user.aliased_to)
+            user.aliased_to = None
+            user.save()
+        return len(users), query.cursor(), len(users) == batch_size
 
-    def remove_alias(self, alias):
-        db.delete(db.Key(UserAlias.kind(), alias))
+    @classmethod
+    def fetch_all(cls):
+        return cls.all()
 
     def list_aliases(self):
         return [k.name() for k 
                 in UserAlias.all(keys_only=True).filter('username', self.username)]
 
 
+def _check_shared(cls, base, names=('save', 'remove')):
+    # Fails at import if db.Model shadows a method wrapped for the caches.
+    for name in names:
+        func = base.__dict__[name]
+        assert getattr(cls, name).__func__ is getattr(func, '__func__', func), \
+            '%s.%s is not %s.%s' % (cls.__name__, name, base.__name__, name)
+
+_check_shared(User, UserBase)
+_check_shared(Permission, PermissionBase)
+
+
 # TODO: Add ratelimiting and/or recaptcha
 # There should be a way for users to provide a username after they do external login
 
 
-class UserAlias(db.Model):
+class UserAlias(Model):
     username = db.StringProperty(required=True)
     # this will only work when using the ModelBackend
     # TODO: this should allow users to change their username
@@ -262,6 +310,6 @@ class UserAlias(db.Model):
 
     #def save(self, force_insert=False):
     #    if force_insert and self._alias:
-    #        return _insert(self, self._alias)
+    #        return _insert(self)
     #    self.put()
     #    return self
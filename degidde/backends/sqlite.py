@@ -0,0 +1,475 @@
+import base64
+import json
+import sqlite3
+import threading
+
+from degidde.models import *
+from degidde.utils import WorkerPool
+
+
+DATABASE = conf.get('SQLITE_DATABASE', 'degidde.sqlite3')
+CACHED_STATEMENTS = conf.get('SQLITE_CACHED_STATEMENTS', 256)
+MULTI_GET_CHUNK = 500 # well under SQLITE_MAX_VARIABLE_NUMBER
+ASYNC_WORKERS = conf.get('SQLITE_ASYNC_WORKERS', 4) # threads running *_async calls
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS session (
+    key_name TEXT PRIMARY KEY,
+    session_data BLOB NOT NULL,
+    expire_date TIMESTAMP NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS session_expire_date ON session (expire_date);
+
+CREATE TABLE IF NOT EXISTS permission (
+    key_name TEXT PRIMARY KEY,
+    prefix TEXT NOT NULL,
+    granted_by TEXT NOT NULL,
+    date_granted TIMESTAMP
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS permission_prefix ON permission (prefix, key_name);
+
+CREATE TABLE IF NOT EXISTS user (
+    key_name TEXT PRIMARY KEY,
+    csusername TEXT,
+    full_name TEXT,
+    email TEXT NOT NULL,
+    password TEXT,
+    "group" TEXT,
+    is_active BOOLEAN,
+    date_validated TIMESTAMP,
+    last_login TIMESTAMP,
+    date_joined TIMESTAMP,
+    aliased_to TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS user_email ON user (email, date_validated);
+CREATE INDEX IF NOT EXISTS user_aliased_to ON user (aliased_to);
+
+CREATE TABLE IF NOT EXISTS useralias (
+    key_name TEXT PRIMARY KEY,
+    username TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS useralias_username ON useralias (username);
+'''
+
+sqlite3.register_converter('BOOLEAN', lambda v: v != b'0')
+
+_local = threading.local()
+_kinds = {}
+_pool = WorkerPool(ASYNC_WORKERS)
+
+
+def connection():
+    # sqlite3 connections can't be shared between threads, but each one keeps
+    # its own cache of compiled statements, so every SQL string below is only
+    # prepared once per thread.
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE, isolation_level=None,
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               cached_statements=CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_SCHEMA)
+        _local.conn = conn
+    return conn
+
+
+class Key(object):
+    __slots__ = ('_kind', '_name')
+
+    def __init__(self, kind, name):
+        self._kind = kind
+        self._name = name
+
+    def kind(self):
+        return self._kind
+
+    def name(self):
+        return self._name
+
+    def __eq__(self, obj):
+        return isinstance(obj, Key) and (self._kind, self._name) == (obj._kind, obj._name)
+
+    def __ne__(self, obj):
+        return not self.__eq__(obj)
+
+    def __hash__(self):
+        return hash((self._kind, self._name))
+
+    def __repr__(self):
+        return 'Key(%r, %r)' % (self._kind, self._name)
+
+
+def dump(obj,):
+    if not isinstance(obj, Key) or obj.name() is None:
+        raise TypeError("Key instance with a name is required")
+    cls = _kinds[obj.kind()]
+    try:
+        return cls.parse_key_name(obj.name())
+    except AttributeError:
+        return obj.name()
+
+
+class Query(object):
+    # Lazy, like db.Query: nothing is read until the results are iterated.
+    # Cursors are keyset positions, (order value, key_name) of the last
+    # row fetched, so resuming from one costs no more than the first page.
+    def __init__(self, cls, where, params=(), order='key_name'):
+        self._cls = cls
+        self._where = where
+        self._params = tuple(params)
+        self._order = order
+        self._start = None
+        self._last = None
+
+    def _run(self, limit=-1, offset=0):
+        where, params = self._where, self._params
+        if self._start is not None:
+            if self._order == 'key_name':
+                where += ' AND key_name > ?'
+            elif self._start[0] is None: # NULLs sort first
+                where += ' AND (%s IS NOT NULL OR key_name > ?)' % self._order
+            else:
+                where += ' AND (%s, key_name) > (?, ?)' % self._order
+            params += tuple(p for p in self._start if p is not None)
+        sql = 'SELECT * FROM %s WHERE %s ORDER BY %s LIMIT ? OFFSET ?' % (
+            self._cls._table, where,
+            self._order if self._order == 'key_name' else self._order + ', key_name')
+        return connection().execute(sql, params + (limit, offset))
+
+    def _position(self, row):
+        if self._order == 'key_name':
+            return [row['key_name']]
+        value = row[self._order]
+        # Compared against the stored text, which is how sqlite3 adapts it.
+        return [value if value is None else unicode(value), row['key_name']]
+
+    def with_cursor(self, cursor):
+        position = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if (not isinstance(position, list)
+                or len(position) != (1 if self._order == 'key_name' else 2)):
+            raise ValueError('Invalid cursor')
+        self._start = position
+        return self
+
+    def cursor(self):
+        if self._last is not None:
+            return base64.urlsafe_b64encode(json.dumps(self._last))
+
+    def __iter__(self):
+        for row in self._run():
+            self._last = self._position(row)
+            yield self._cls._from_row(row)
+
+    def fetch(self, limit, offset=0):
+        rows = self._run(limit, offset).fetchall()
+        if rows:
+            self._last = self._position(rows[-1])
+        return [self._cls._from_row(row) for row in rows]
+
+    def get(self):
+        row = self._run(1).fetchone()
+        if row is not None:
+            return self._cls._from_row(row)
+
+    def keys(self):
+        return [row['key_name'] for row in self._run()]
+
+
+class Model(object):
+    _table = None
+    _fields = () # (name, default) pairs, in column order
+
+    def __init__(self, key_name=None, **kwargs):
+        for name, default in self._fields:
+            value = kwargs.pop(name, None)
+            if value is None:
+                value = default() if callable(default) else default
+            setattr(self, name, value)
+        self._key_name = key_name
+        self._saved = False
+
+    @classmethod
+    def _prepare(cls):
+        columns = ('key_name',) + tuple(name for name, _ in cls._fields) + cls._extra_columns()
+        placeholders = ', '.join('?' * len(columns))
+        columns = ', '.join('"%s"' % c for c in columns)
+        cls._sql_get = 'SELECT * FROM %s WHERE key_name = ?' % cls._table
+        cls._sql_get_many = 'SELECT * FROM %s WHERE key_name IN (%%s)' % cls._table
+        cls._sql_put = 'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (
+            cls._table, columns, placeholders)
+        cls._sql_insert = 'INSERT OR IGNORE INTO %s (%s) VALUES (%s)' % (
+            cls._table, columns, placeholders)
+        cls._sql_delete = 'DELETE FROM %s WHERE key_name = ?' % cls._table
+        _kinds[cls.kind()] = cls
+        return cls
+
+    @classmethod
+    def _extra_columns(cls):
+        return ()
+
+    def _extra_values(self):
+        return ()
+
+    @classmethod
+    def kind(cls):
+        return cls.__name__
+
+    @classmethod
+    def _from_row(cls, row):
+        obj = cls.__new__(cls)
+        for name, _ in cls._fields:
+            setattr(obj, name, row[name])
+        obj._key_name = row['key_name']
+        obj._saved = True
+        obj._loaded()
+        return obj
+
+    def _loaded(self):
+        pass
+
+    def _values(self):
+        return ((self._key_name,)
+                + tuple(getattr(self, name) for name, _ in self._fields)
+                + self._extra_values())
+
+    def key(self):
+        return Key(self.kind(), self._key_name)
+
+    def is_saved(self):
+        return self._saved
+
+    @classmethod
+    def get_by_key_name(cls, key_name):
+        if isinstance(key_name, (list, tuple)):
+            return cls._get_many(key_name)
+        row = connection().execute(cls._sql_get, (key_name,)).fetchone()
+        if row is not None:
+            return cls._from_row(row)
+
+    @classmethod
+    def _get_many(cls, key_names, _chunk=MULTI_GET_CHUNK):
+        # Like db.get with a list: input order, None for missing keys.
+        found = {}
+        conn = connection()
+        for i in range(0, len(key_names), _chunk):
+            chunk = key_names[i:i + _chunk]
+            sql = cls._sql_get_many % ', '.join('?' * len(chunk))
+            for row in conn.execute(sql, chunk):
+                found[row['key_name']] = row
+        return [cls._from_row(found[k]) if k in found else None for k in key_names]
+
+    @classmethod
+    def get_by_key_name_async(cls, key_name):
+        return _pool.start(cls.get_by_key_name, key_name)
+
+    @classmethod
+    def delete_by_key_name(cls, key_name):
+        connection().execute(cls._sql_delete, (key_name,))
+
+    def put(self):
+        connection().execute(self._sql_put, self._values())
+        self._saved = True
+        return self.key()
+
+    def _put_async(self):
+        return _pool.start(self.put)
+
+    def _insert(self):
+        # A single statement, so the check and the write are atomic.
+        # Only a locked database (beyond the busy timeout) is retried.
+        cursor = retry(lambda: connection().execute(self._sql_insert, self._values()),
+                       sqlite3.OperationalError, INSERT_RETRIES, INSERT_BACKOFF)
+        if cursor.rowcount:
+            self._saved = True
+            return self
+
+
+class Session(Model):
+    _table = 'session'
+    _fields = (('session_data', None), ('expire_date', None))
+
+    def __init__(self, *args, **kwargs):
+        key = kwargs.pop('session_key', None)
+        super(Session, self).__init__(key, *args, **kwargs)
+        self._session_key = key
+
+    def _loaded(self):
+        self.session_data = bytes(self.session_data)
+        self._session_key = self._key_name
+
+    def _values(self):
+        values = super(Session, self)._values()
+        return values[:1] + (sqlite3.Binary(values[1]),) + values[2:]
+
+    @property
+    def session_key(self):
+        return self._key_name
+
+    @classmethod
+    def fetch(cls, session_key):
+        return cls.get_by_key_name(session_key)
+
+    @classmethod
+    def fetch_many(cls, session_keys):
+        return cls.get_by_key_name(list(session_keys))
+
+    @classmethod
+    def remove(cls, session_key):
+        cls.delete_by_key_name(session_key)
+
+    def save(self, force_insert=False):
+        if force_insert and self._session_key:
+            return self._insert()
+        self.put()
+        return self
+
+    _sql_expired = 'SELECT key_name FROM session WHERE expire_date < ? ORDER BY expire_date LIMIT ?'
+
+    @classmethod
+    def purge_expired(cls, batch_size=500, cursor=None, now=None):
+        # Deleted rows leave the index, so every batch starts from the
+        # oldest remaining one and no cursor is needed.
+        conn = connection()
+        keys = [row['key_name'] for row in conn.execute(
+            cls._sql_expired, (now or datetime.datetime.now(), batch_size))]
+        if keys:
+            conn.executemany(cls._sql_delete, [(k,) for k in keys])
+        return len(keys), None, len(keys) == batch_size
+
+    purge_unindexed = purge_expired # every row is indexed here
+
+    @classmethod
+    def count_expired(cls, limit=1000, now=None):
+        return connection().execute(
+            'SELECT count(*) FROM (%s)' % cls._sql_expired,
+            (now or datetime.datetime.now(), limit)).fetchone()[0]
+
+Session._prepare()
+
+
+class Permission(Model, PermissionBase):
+    _table = 'permission'
+    _fields = (('granted_by', None), ('date_granted', datetime.datetime.now))
+
+    _sql_prefix = 'prefix = ?'
+
+    def __init__(self, *args, **kwargs):
+        perm = kwargs.pop('perm', None)
+        username = kwargs.pop('username', None)
+        group = kwargs.pop('group', None)
+        validate_permission(username, group, perm)
+        key = self._make_key_name(username, group, perm)
+        self.username = username
+        self.group = group
+        self.perm = perm
+        super(Permission, self).__init__(key, *args, **kwargs)
+
+    def _loaded(self):
+        self.username, self.group, self.perm = self.parse_key_name(self._key_name)
+
+    @classmethod
+    def _extra_columns(cls):
+        return ('prefix',)
+
+    def _extra_values(self):
+        return (self._key_name.split(self._perm_pre, 1)[0],)
+
+    @classmethod
+    def _prefix_query(cls, key):
+        return Query(cls, cls._sql_prefix, (key[:-len(cls._perm_pre)],))
+
+    @classmethod
+    def _remove_prefix(cls, key):
+        connection().execute('DELETE FROM permission WHERE ' + cls._sql_prefix,
+                             (key[:-len(cls._perm_pre)],))
+
+    @classmethod
+    def _list_async(cls, query):
+        return _pool.start(list, query)
+
+Permission._prepare()
+
+
+class User(Model, UserBase):
+    _table = 'user'
+    _fields = (
+        ('csusername', None), # Case sensitive username
+        ('full_name', None),
+        ('email', None),
+        ('password', UNUSABLE_PASSWORD),
+        ('group', None),
+        ('is_active', True),
+        ('date_validated', FUTURE_DATETIME),
+        ('last_login', datetime.datetime.now),
+        ('date_joined', datetime.datetime.now),
+        ('aliased_to', None),
+    )
+
+    def __init__(self, *args, **kwargs):
+        key = kwargs.pop('username', None)
+        Model.__init__(self, key, *args, **kwargs)
+        self._username = key
+
+    def _loaded(self):
+        self._username = self._key_name
+
+    @property
+    def username(self):
+        return self._key_name
+
+    def _insert_async(self):
+        return _pool.start(self._insert)
+
+    @classmethod
+    def _by_email(cls, email):
+        return Query(cls, 'email = ?', (email,), order='date_validated')
+
+    @classmethod
+    def _first_async(cls, query):
+        return _pool.start(query.get)
+
+    @classmethod
+    def _commit_aliases(cls, aliases):
+        conn = connection()
+        conn.executemany(UserAlias._sql_put, [UserAlias(alias, username=username)._values()
+                                              for username, alias in aliases.items()])
+        users = [u for u in cls.get_by_key_name(list(aliases))
+                 if u and u.aliased_to == aliases[u.username]]
+        for user in users:
+            user.aliased_to = None
+        conn.executemany(cls._sql_put, [user._values() for user in users])
+
+    @classmethod
+    def migrate_aliases(cls, batch_size=500, cursor=None):
+        '''
+        Moves one batch of aliases from aliased_to to UserAlias.
+        Returns (migrated, cursor to resume from, whether more may remain).
+        '''
+        query = Query(cls, 'aliased_to IS NOT NULL')
+        if cursor:
+            query.with_cursor(cursor)
+        users = query.fetch(batch_size)
+        for user in users:
+            # Alias first, so an interrupted batch can just be run again.
+            user.save_alias(user.aliased_to)
+            user.aliased_to = None
+            user.save()
+        return len(users), query.cursor(), len(users) == batch_size
+
+    @classmethod
+    def fetch_all(cls):
+        return Query(cls, '1')
+
+    def list_aliases(self):
+        return Query(UserAlias, 'username = ?', (self.username,)).keys()
+
+User._prepare()
+
+
+class UserAlias(Model):
+    _table = 'useralias'
+    _fields = (('username', None),)
+
+UserAlias._prepare()
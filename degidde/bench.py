@@ -0,0 +1,276 @@
+'''
+Microbenchmarks, run against the configured settings and MODELS_BACKEND:
+
+    python -m degidde.bench [name ...]
+'''
+import collections
+import datetime
+import itertools
+import sys
+import time
+
+
+def _best(func, number, repeat=3):
+    # Seconds per call, best of `repeat` runs.
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            func()
+        t = (time.time() - start) / number
+        best = t if best is None else min(best, t)
+    return best
+
+
+def _sample_session(size):
+    from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY
+
+    session = {
+        SESSION_KEY: u'someuser',
+        BACKEND_SESSION_KEY: 'degidde.auth_backends.ModelBackend',
+    }
+    for i in range(size):
+        session['key%d' % i] = (u'value %d' % i, i, datetime.datetime(2012, 1, 1))
+    return session
+
+
+def session_codec(number=2000, sizes=(0, 10, 100)):
+    from .session_backend import SessionStore
+    from .session_codec import LegacyCodec, BinaryCodec
+
+    store = SessionStore()
+    codecs = [
+        ('legacy', LegacyCodec()),
+        ('binary', BinaryCodec(compress_threshold=None)),
+        ('binary+zlib', BinaryCodec()),
+    ]
+    rows = []
+    for size in sizes:
+        session = _sample_session(size)
+        for name, codec in codecs:
+            data = codec.encode(store, session)
+            rows.append(collections.OrderedDict([
+                ('entries', len(session)),
+                ('codec', name),
+                ('bytes', len(data)),
+                ('encode_us', _best(lambda: codec.encode(store, session), number) * 1e6),
+                ('decode_us', _best(lambda: codec.decode(store, data), number) * 1e6),
+            ]))
+    return rows
+
+
+def session_create(threads=(1, 4, 16), per_thread=200):
+    # Every SessionStore.create generates a fresh key and does an atomic
+    # insert-if-absent, so this measures that path under concurrency.
+    import threading
+    from .session_backend import SessionStore
+
+    def work():
+        for _ in range(per_thread):
+            SessionStore().create()
+
+    rows = []
+    for n in threads:
+        workers = [threading.Thread(target=work) for _ in range(n)]
+        start = time.time()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        seconds = time.time() - start
+        rows.append(collections.OrderedDict([
+            ('threads', n),
+            ('sessions', n * per_thread),
+            ('seconds', seconds),
+            ('per_second', n * per_thread / seconds),
+        ]))
+    return rows
+
+
+def _legacy_encoder():
+    # utils.Encoder as it was before serializers were registered per type.
+    from json import JSONEncoder
+    from .models import dump
+
+    class LegacyEncoder(JSONEncoder):
+        def default(self, obj):
+            try:
+                return dump(obj)
+            except TypeError:
+                pass
+            try:
+                return obj.dump()
+            except AttributeError:
+                pass
+            try:
+                return list(obj)
+            except TypeError:
+                pass
+            return super(LegacyEncoder, self).default(obj)
+    return LegacyEncoder()
+
+
+def encoder(number=200, sizes=(1, 50, 500)):
+    from .models import User
+    from .utils import Encoder
+
+    encoders = [
+        ('legacy', _legacy_encoder()),
+        ('registry', Encoder()),
+    ]
+    rows = []
+    for size in sizes:
+        users = [User(username=u'user%d' % i, email=u'user%d@example.com' % i,
+                      full_name=u'User %d' % i)
+                 for i in range(size)]
+        for name, enc in encoders:
+            rows.append(collections.OrderedDict([
+                ('users', size),
+                ('encoder', name),
+                ('us', _best(lambda: enc.encode(users), number) * 1e6),
+            ]))
+    return rows
+
+
+def availability(sizes=(1000, 10000, 100000), probes=10000):
+    # A filter sized for `n` entries and holding that many: build and lookup
+    # cost, and the estimated false positive rate against the measured one.
+    from .availability import BloomFilter
+
+    rows = []
+    for n in sizes:
+        f = BloomFilter(capacity=n)
+        start = time.time()
+        for i in range(n):
+            f.add(u'username:user%d' % i)
+        build = time.time() - start
+        absent = [u'username:other%d' % i for i in range(probes)]
+        start = time.time()
+        false = sum(1 for key in absent if key in f)
+        lookup = (time.time() - start) / probes
+        rows.append(collections.OrderedDict([
+            ('entries', n),
+            ('bytes', len(f.bits)),
+            ('build_ms', build * 1e3),
+            ('lookup_us', lookup * 1e6),
+            ('estimated_fp_pct', f.false_positive_rate * 100),
+            ('measured_fp_pct', false * 100.0 / probes),
+        ]))
+    return rows
+
+
+class _SlowConnection(object):
+    # Adds a fixed delay to every statement, like a datastore round trip.
+    def __init__(self, conn, delay):
+        self._conn = conn
+        self._delay = delay
+
+    def execute(self, *args):
+        time.sleep(self._delay)
+        return self._conn.execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def overlap(delay=0.02, number=20):
+    # The lookups of views.service_callback and of UserCreationForm, one
+    # after the other and started together, with every RPC delayed. Only
+    # for the sqlite backend, whose connections can be stubbed.
+    from .backends import sqlite
+    from .models import User
+
+    if User is not sqlite.User:
+        return []
+    lookups = [
+        ('callback', lambda i: User.fetch_by_alias(u'ext%d' % i),
+                     lambda i: User.fetch_by_email(u'ext%d@example.com' % i),
+                     lambda i: User.fetch_by_alias_async(u'ext%d' % i),
+                     lambda i: User.fetch_by_email_async(u'ext%d@example.com' % i)),
+        ('signup', lambda i: User.fetch(u'new%d' % i),
+                   lambda i: User.fetch_by_email(u'new%d@example.com' % i),
+                   lambda i: User.fetch_async(u'new%d' % i),
+                   lambda i: User.fetch_by_email_async(u'new%d@example.com' % i)),
+    ]
+    connection = sqlite.connection
+    sqlite.connection = lambda: _SlowConnection(connection(), delay)
+    rows = []
+    try:
+        # Distinct names, so no lookup is answered by a cache.
+        counter = itertools.count()
+        for name, first, second, first_async, second_async in lookups:
+            def sequential():
+                i = next(counter)
+                first(i), second(i)
+            def overlapped():
+                i = next(counter)
+                a, b = first_async(i), second_async(i)
+                a.get_result(), b.get_result()
+            rows.append(collections.OrderedDict([
+                ('lookups', name),
+                ('rpc_ms', delay * 1e3),
+                ('sequential_ms', _best(sequential, number) * 1e3),
+                ('overlapped_ms', _best(overlapped, number) * 1e3),
+            ]))
+    finally:
+        sqlite.connection = connection
+    return rows
+
+
+def hashing(iterations=(1000, 10000, 100000), number=5):
+    # Password checks, hence logins, per second on one core for each cost,
+    # against Django's salted sha1 that older hashes use.
+    from django.contrib.auth.models import User as _User
+    from .hashers import make_password, check_password
+    from .models import User
+
+    rows = []
+    legacy = User(username=u'someuser', email=u'someuser@example.com')
+    _User.set_password(legacy, 'secret')
+    t = _best(lambda: legacy.check_password('secret'), number * 100)
+    rows.append(collections.OrderedDict([
+        ('hasher', legacy.password.split('$', 1)[0]),
+        ('iterations', 1),
+        ('check_ms', t * 1e3),
+        ('logins_per_second', 1 / t),
+    ]))
+    for n in iterations:
+        encoded = make_password('secret', n)
+        t = _best(lambda: check_password('secret', encoded), number)
+        rows.append(collections.OrderedDict([
+            ('hasher', encoded.split('$', 1)[0]),
+            ('iterations', n),
+            ('check_ms', t * 1e3),
+            ('logins_per_second', 1 / t),
+        ]))
+    return rows
+
+
+BENCHMARKS = {
+    'availability': availability,
+    'codec': session_codec,
+    'encoder': encoder,
+    'hashing': hashing,
+    'overlap': overlap,
+    'session_create': session_create,
+}
+
+
+def report(name, rows, out=sys.stdout):
+    out.write('== %s\n' % name)
+    if not rows:
+        return
+    columns = list(rows[0])
+    out.write('\t'.join(columns) + '\n')
+    for row in rows:
+        out.write('\t'.join(isinstance(row[c], float) and '%.2f' % row[c] or str(row[c])
+                            for c in columns) + '\n')
+
+
+def main(argv):
+    for name in argv[1:] or sorted(BENCHMARKS):
+        report(name, BENCHMARKS[name]())
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,11 +1,14 @@
 import functools
+import math
 import time
 import urlparse
 
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden
 
+from .auth_backends import ModelBackend
 from .models import AnonymousUser
+from .permissions import table as perm_table
 from .services import get_service, LOGIN_SERVICE_KEY
 from .utils import addr, DEGIDDE
 
@@ -25,28 +28,62 @@ VALIDATE_URL = getattr(settings, 'VALIDATE_URL', '/validate')
 # Trying to login with same username from multiple locations simultaneosly is suspicious behavior.
 # Remember throttling password reset link, and other views, besides login.
 # What about "rememberme", i.e. session cookies that last indefinitely?
+def _retry_after(prev, cur, maxc, period, elapsed):
+    # Seconds until the sliding estimate drops below maxc again.
+    if cur < maxc:
+        # The previous window's share is what's over, and it decays in this one.
+        return period * (1 - float(maxc - cur) / prev) - elapsed
+    return period - elapsed + period * (1 - float(maxc) / cur)
+
+
 def throttle(function=None, scope=None, _sep='|'):
-    from django.core import cache
+    from django.core.cache import cache
 
     # Throttling is done per user, or per IP if the user is anonymous.
     # Due to this, login will effectively have the lowest possible 
     # max rate (*more accurately* changing the session cookie!). 
     # The global max rate is effectively the greatest possible max rate.
 
+    # Counts live in a ring of 3 buckets per limit. A bucket expires 2 periods
+    # after its first hit, so it outlives its turn as the previous window but
+    # is gone before the ring comes back to it.
+    # The count is estimated as the current bucket plus the previous one
+    # weighted by how much of it still overlaps the sliding window.
+    limits = [('', GLOBAL_MAXC, GLOBAL_PERIOD)]
+
     def actual_decorator(view):
         @functools.wraps(view)
         def wrapper(request, *args, **kwargs):
+            user = request.user
             client_id = user.is_anonymous() and addr(request) or user.id
-            t = int(time.time())
-            index = (t // period) % 3
-            gindex = (t // GLOBAL_PERIOD) % 3           
-
-            if scope:
-                key = client_id + _sep + scope + str(index)
-            gkey = client_id + _sep + str(index)
-            #...
-            if exceeded:
-                return HttpResponse(status_code=503)
+            client_id = client_id.replace(' ', '') + _sep
+            t = time.time()
+
+            buckets = []
+            for name, maxc, period in limits:
+                window = int(t // period)
+                key = client_id + name + _sep
+                buckets.append((key + str(window % 3), key + str((window - 1) % 3)))
+            counts = cache.get_many([k for bucket in buckets for k in bucket])
+
+            retry_after = 0
+            for (key, prev_key), (name, maxc, period) in zip(buckets, limits):
+                cur, prev = counts.get(key, 0), counts.get(prev_key, 0)
+                elapsed = t % period
+                if prev * (1 - elapsed / period) + cur >= maxc:
+                    retry_after = max(retry_after,
+                                      _retry_after(prev, cur, maxc, period, elapsed))
+            if retry_after:
+                response = HttpResponse(status=503)
+                response['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+                return response
+
+            for (key, _), (name, maxc, period) in zip(buckets, limits):
+                if not cache.add(key, 1, 2 * period):
+                    try:
+                        cache.incr(key)
+                    except ValueError: # expired in between
+                        cache.add(key, 1, 2 * period)
             return view(request, *args, **kwargs)
         return wrapper
 
@@ -55,6 +92,7 @@ def throttle(function=None, scope=None, _sep='|'):
             maxc, period = SCOPES[scope]
         except KeyError:
             raise ValueError("Unknown scope %s" % scope)    
+        limits.append((scope, maxc, period))
     
     if function:
         return actual_decorator(function)
@@ -108,3 +146,20 @@ def sensitive(function=None, safe_login=True):
         return actual_decorator(function)
     return actual_decorator
 
+
+def permission_required(*perms):
+    # The permissions are compiled into a mask once, when decorating.
+    mask = perm_table.mask(perms)
+    if mask is None:
+        raise ValueError("Unknown permission in %s" % (perms,))
+    backend = ModelBackend()
+
+    def actual_decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            user = request.user
+            if not (user.is_authenticated() and backend.has_mask(user, mask)):
+                return HttpResponseForbidden()
+            return view(request, *args, **kwargs)
+        return wrapper
+    return actual_decorator
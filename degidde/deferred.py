@@ -0,0 +1,104 @@
+import hashlib
+import logging
+import threading
+
+from django.core.signals import request_finished
+
+from .models import conf, User
+from .utils import retry
+try:
+    from google.appengine.ext.deferred import defer
+except ImportError:
+    defer = None
+
+
+RETRIES = conf.get('DEFERRED_RETRIES', 3)
+BACKOFF = conf.get('DEFERRED_BACKOFF', 0.05) # seconds, doubled on each retry
+PENDING_TIMEOUT = conf.get('DEFERRED_PENDING_TIMEOUT', 600) # seconds a write counts as queued
+
+_queues = {} # name -> WriteQueue
+
+
+class WriteQueue(object):
+    '''
+    Coalesces writes by key in process, and hands them to `func` as one
+    {key: value} batch per flush. A write already queued, by this or any
+    other process, is not queued again: adding one only costs a cache add.
+
+    On App Engine, flush sends the batch to the task queue, as a single
+    task, and is run by DeferredWritesMiddleware before the response is
+    returned, since responses are buffered until the request ends.
+    Elsewhere the batch is run once the response has been sent, and kept
+    for the next flush if it still fails after retries. `func` must be
+    safe to run more than once for the same batch.
+    '''
+    def __init__(self, name, func, retries=RETRIES, backoff=BACKOFF):
+        self.name = name
+        self.func = func
+        self.retries = retries
+        self.backoff = backoff
+        self.pending = {}
+        self._lock = threading.Lock()
+        _queues[name] = self
+
+    def _marker(self, key, value):
+        return '%s:%s:%s' % (__name__, self.name,
+                             hashlib.md5(repr((key, value))).hexdigest())
+
+    def add(self, key, value):
+        from django.core.cache import cache
+
+        if not cache.add(self._marker(key, value), 1, PENDING_TIMEOUT):
+            return # already queued
+        with self._lock:
+            self.pending[key] = value # the latest write wins
+
+    def run(self, batch):
+        retry(lambda: self.func(batch), Exception, self.retries, self.backoff)
+        self.done(batch)
+
+    def done(self, batch):
+        from django.core.cache import cache
+
+        cache.delete_many([self._marker(k, v) for k, v in batch.items()])
+
+    def flush(self):
+        with self._lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        try:
+            if defer is not None:
+                defer(_run, self.name, batch)
+            else:
+                self.run(batch)
+        except Exception:
+            logging.exception("Deferred writes failed, will retry")
+            with self._lock:
+                for key, value in batch.items():
+                    self.pending.setdefault(key, value)
+
+
+def _run(name, batch):
+    # What the task queue runs; module level, so it can be pickled.
+    _queues[name].run(batch)
+
+
+def flush(**kwargs):
+    for q in _queues.values():
+        q.flush()
+
+# For requests without DeferredWritesMiddleware, and outside App Engine.
+request_finished.connect(flush)
+
+
+aliases = WriteQueue('aliases', User.commit_aliases)
+
+
+def commit_alias(user, alias):
+    '''
+    Saves the alias after the response. Until then it only resolves
+    through the cache, and user.aliased_to, which is saved, remembers it.
+    '''
+    User.prime_alias(alias, user.username)
+    aliases.add(user.username, alias)
@@ -3,11 +3,14 @@ import urlparse
 
 from django import forms
 from django.conf import settings
-from django.contrib.auth import forms as auth, login, REDIRECT_FIELD_NAME, SESSION_KEY
+from django.contrib.auth import forms as auth, authenticate, login, REDIRECT_FIELD_NAME, \
+    SESSION_KEY
 from django.core import validators
 from django.http import HttpResponseRedirect, QueryDict
 from django.utils.translation import ugettext_lazy as _
 
+from . import abuse
+from .availability import user_added
 from .models import User, UsernameTakenError
 from .utils import same_origin_redirect, FUTURE_DATETIME
 from .services import service_session
@@ -42,14 +45,27 @@ class UserCreationForm(auth.UserCreationForm):
 
     def clean_username(self):
         username = self.cleaned_data['username']
-        if User.fetch(username):
+        # Usernames are stored lowercased, see clean. The availability
+        # filter can miss recent users, so it is not consulted here.
+        taken = User.fetch_async(username.lower())
+        # Fields are cleaned one at a time, so the email lookup is started
+        # here, from the raw value, to overlap with this one.
+        email = (self.data.get(self.add_prefix('email')) or u'').strip().lower()
+        if email:
+            self._email_lookup = (email, User.fetch_by_email_async(email))
+        if taken.get_result():
             raise forms.ValidationError(_("This username is already taken."))
         return username
 
     def clean_email(self):
         email = self.cleaned_data['email'].lower()
         
-        if User.fetch_by_email(email):
+        started = getattr(self, '_email_lookup', None)
+        if started and started[0] == email:
+            taken = started[1]
+        else:
+            taken = User.fetch_by_email_async(email)
+        if taken.get_result():
             raise forms.ValidationError(_("This email is already registered."))
                                           #"Want to login or recover your password?")) # Add this with javascript
         return email
@@ -62,8 +78,8 @@ class UserCreationForm(auth.UserCreationForm):
             username = username.lower()
         user = User(
             username=username,
-            email=self.cleaned_data['email']
-            full_name=self.cleaned_data.get('full_name')
+            email=self.cleaned_data['email'],
+            full_name=self.cleaned_data.get('full_name'),
             **kwargs)
         user.set_password(self.cleaned_data['password1'])
         self.user = user
@@ -73,8 +89,8 @@ class UserCreationForm(auth.UserCreationForm):
         if commit:
             if self.login:
                 self.login(self.user)
-            else:
-                self.user.save(force_insert=True)
+            elif self.user.save(force_insert=True):
+                user_added(self.user)
         return self.user
 
     def login(self, user):
@@ -84,6 +100,7 @@ class UserCreationForm(auth.UserCreationForm):
             saved = user.save(force_insert=force_insert)
             if not saved:
                 raise UsernameTakenError #Very unlikely
+            user_added(user)
             user.save = _old_save
             return user
 
@@ -138,6 +155,8 @@ class AuthenticationForm(forms.Form):
     def clean(self):
         username = self.cleaned_data['username'].lower()
         password = self.cleaned_data['password']
+        if abuse.locked_out(username):
+            raise forms.ValidationError(_("Too many failed attempts. Please try again later."))
         self.user = authenticate(username=username, password=password)
         if self.user is None:
             raise forms.ValidationError(_("Please enter a correct username and password."))
@@ -0,0 +1,99 @@
+import base64
+import hashlib
+import hmac
+import os
+import struct
+
+from .models import conf, Error
+from .utils import WorkerPool
+
+
+ALGORITHM = 'pbkdf2_sha256'
+ITERATIONS = conf.get('PASSWORD_ITERATIONS', 10000)
+WORKERS = conf.get('PASSWORD_WORKERS') # threads hashing passwords, None for inline
+MAX_PENDING = conf.get('PASSWORD_MAX_PENDING', 32) # queued hashes before Busy
+
+try:
+    from hashlib import pbkdf2_hmac
+except ImportError: # before Python 2.7.8
+    def pbkdf2_hmac(name, password, salt, iterations):
+        digest = getattr(hashlib, name)
+        mac = hmac.new(password, digestmod=digest)
+        def prf(data):
+            h = mac.copy()
+            h.update(data)
+            return bytearray(h.digest())
+        u = prf(salt + struct.pack('>I', 1))
+        result = bytearray(u)
+        for _ in range(iterations - 1):
+            u = prf(bytes(u))
+            for i, b in enumerate(u):
+                result[i] ^= b
+        return bytes(result)
+
+
+class Busy(Error):
+    pass
+
+
+def _encode(value):
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return value
+
+
+def _hash(password, salt, iterations):
+    digest = pbkdf2_hmac('sha256', _encode(password), _encode(salt), iterations)
+    return base64.b64encode(digest).decode('ascii')
+
+
+# The same format as Django's PBKDF2PasswordHasher.
+def make_password(password, iterations=ITERATIONS, salt=None):
+    salt = salt or base64.b64encode(os.urandom(9)).decode('ascii')
+    return '%s$%d$%s$%s' % (ALGORITHM, iterations, salt, _hash(password, salt, iterations))
+
+
+def check_password(password, encoded):
+    '''
+    Returns None for hashes not made by make_password, e.g. Django's sha1.
+    '''
+    try:
+        algorithm, iterations, salt, digest = encoded.split('$', 3)
+    except (AttributeError, ValueError):
+        return
+    if algorithm != ALGORITHM:
+        return
+    return _compare(_hash(password, salt, int(iterations)), digest)
+
+
+def _compare(a, b):
+    # Constant time, so the time taken says nothing about the hash.
+    if len(a) != len(b):
+        return False
+    r = 0
+    for x, y in zip(a, b):
+        r |= ord(x) ^ ord(y)
+    return r == 0
+
+
+def must_update(encoded):
+    try:
+        algorithm, iterations, _ = encoded.split('$', 2)
+        return algorithm != ALGORITHM or int(iterations) != ITERATIONS
+    except (AttributeError, ValueError):
+        return True
+
+
+_pool = WORKERS and WorkerPool(WORKERS)
+
+
+def run(func, *args):
+    '''
+    Runs hashing on the pool, when there is one, so that at most WORKERS
+    threads spend CPU on it. Raises Busy when too many hashes are waiting.
+    '''
+    if not _pool:
+        return func(*args)
+    if _pool.calls.qsize() >= MAX_PENDING:
+        raise Busy
+    return _pool.start(func, *args).get_result()
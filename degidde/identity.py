@@ -0,0 +1,124 @@
+import functools
+import threading
+
+from .utils import Future
+
+
+_local = threading.local()
+_forget = object()
+
+
+class IdentityMap(object):
+    # (kind, key) -> entity, or None for one known to be missing.
+    def __init__(self):
+        self.entries = {}
+        self.saved = 0 # datastore or cache calls answered from the map
+
+    def drop(self, kind):
+        for key in [k for k in self.entries if k[0] == kind]:
+            del self.entries[key]
+
+
+def current():
+    return getattr(_local, 'map', None)
+
+
+def begin():
+    _local.map = IdentityMap()
+    return _local.map
+
+
+def end():
+    _local.map = None
+
+
+def _key(kind, key_func, args, kwargs):
+    m = current()
+    if m is not None:
+        key = key_func(*args, **kwargs)
+        if key:
+            return m, (kind, key)
+    return None, None
+
+
+def _entity(m, entity, data):
+    # The instance already mapped under the entity's own key, if any.
+    if entity is None or data is None:
+        return data
+    kind, key_func = entity
+    return m.entries.setdefault((kind, key_func(data)), data)
+
+
+def mapped(kind, key_func, entity=None):
+    '''
+    Within a request, answers repeated calls from the request's map.
+    key_func returns a false value for calls that must not be mapped.
+    For lookups by something else than the key, entity is (kind, key_func)
+    of the results, so that they share instances with lookups by key.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def w(*args, **kwargs):
+            m, key = _key(kind, key_func, args, kwargs)
+            if m is None:
+                return func(*args, **kwargs)
+            if key in m.entries:
+                m.saved += 1
+                return m.entries[key]
+            data = m.entries[key] = _entity(m, entity, func(*args, **kwargs))
+            return data
+        return w
+    return decorator
+
+
+def mapped_async(kind, key_func, entity=None):
+    # Like mapped, for the *_async variants.
+    def decorator(func):
+        @functools.wraps(func)
+        def w(*args, **kwargs):
+            m, key = _key(kind, key_func, args, kwargs)
+            if m is None:
+                return func(*args, **kwargs)
+            if key in m.entries:
+                m.saved += 1
+                return Future(result=m.entries[key])
+            def done(data):
+                data = m.entries[key] = _entity(m, entity, data)
+                return data
+            return func(*args, **kwargs).then(done)
+        return w
+    return decorator
+
+
+def _writes(kind, key_func, value, drop):
+    def decorator(func):
+        @functools.wraps(func)
+        def w(*args, **kwargs):
+            r = func(*args, **kwargs)
+            m, key = _key(kind, key_func, args, kwargs)
+            if m is not None:
+                v = value(args, r)
+                if v is _forget:
+                    m.entries.pop(key, None)
+                else:
+                    m.entries[key] = v
+            m = current()
+            if m is not None:
+                for k in drop:
+                    m.drop(k)
+            return r
+        return w
+    return decorator
+
+
+def saves(kind, key_func, drop=()):
+    # The saved object becomes the entry, unless nothing was saved.
+    return _writes(kind, key_func, lambda args, r: args[0] if r is not None else _forget, drop)
+
+
+def removes(kind, key_func, drop=()):
+    return _writes(kind, key_func, lambda args, r: None, drop)
+
+
+def forgets(kind, key_func, drop=()):
+    return _writes(kind, key_func, lambda args, r: _forget, drop)
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from degidde.models import migrate_aliases
+
+
+class Command(NoArgsCommand):
+    help = "Moves aliases kept in User.aliased_to to UserAlias entities."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help="Users migrated per datastore call."),
+        make_option('--deadline', type='float', default=None,
+                    help="Stop after this many seconds, and print a cursor to resume from."),
+        make_option('--cursor', default=None,
+                    help="Resume from the cursor printed by a previous run."),
+    )
+
+    def handle_noargs(self, batch_size=500, deadline=None, cursor=None, **options):
+        r = migrate_aliases(batch_size, deadline, cursor)
+        self.stdout.write("Migrated %(migrated)d aliases in %(batches)d batches, "
+                          "%(seconds).1fs.\n" % r)
+        if r['cursor']:
+            self.stdout.write("Resume with --cursor=%s\n" % r['cursor'])
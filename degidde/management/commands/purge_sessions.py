@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from degidde.session_backend import purge_expired
+
+
+class Command(NoArgsCommand):
+    help = "Deletes expired sessions in batches."
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help="Sessions deleted per datastore call."),
+        make_option('--deadline', type='float', default=None,
+                    help="Stop after this many seconds, and print a cursor to resume from."),
+        make_option('--cursor', default=None,
+                    help="Resume from the cursor printed by a previous run."),
+        make_option('--scan', action='store_true', default=False,
+                    help="Check every session, to also find those saved "
+                         "before expire_date was indexed."),
+    )
+
+    def handle_noargs(self, batch_size=500, deadline=None, cursor=None, scan=False,
+                      **options):
+        r = purge_expired(batch_size, deadline, cursor, scan=scan)
+        self.stdout.write("Deleted %(deleted)d sessions in %(batches)d batches, "
+                          "%(seconds).1fs (%(per_second).0f/s). "
+                          "Remaining: %(remaining)d\n" % r)
+        if r['cursor']:
+            self.stdout.write("Resume with %s--cursor=%s\n"
+                              % (scan and '--scan ' or '', r['cursor']))
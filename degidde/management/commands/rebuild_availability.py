@@ -0,0 +1,15 @@
+from django.core.management.base import NoArgsCommand
+
+from degidde.availability import taken
+
+
+class Command(NoArgsCommand):
+    help = "Rebuilds the filter of taken usernames and emails used at signup."
+
+    def handle_noargs(self, **options):
+        r = taken.rebuild()
+        if r is None:
+            self.stdout.write("A rebuild is already in progress.\n")
+            return
+        self.stdout.write("Indexed %(users)d users in %(seconds).1fs, %(bytes)d bytes.\n" % r)
+        self.stdout.write("False positive rate: %.4f\n" % taken.stats['false_positive_rate'])
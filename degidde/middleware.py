@@ -2,6 +2,7 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured 
 from django.http import HttpResponseRedirect
 
+from . import abuse, deferred, identity
 from .auth_backends import ModelBackend
 from .models import UnconfirmedPropertyError
 from .services import UnaccessibleServiceError
@@ -12,13 +13,12 @@ def _get_user(desc, request, obj_type=None, _get=LazyUser.__get__):
     if user.is_external():
         user._request = request
 
-    # Commit the alias.
+    # Commit the alias, after the response.
     # QUIRK: make sure this is run soon after the user is aliased,
     # or else the alias will be overridden
     if user.aliased_to:
-        user.save_alias(user.aliased_to)
+        deferred.commit_alias(user, user.aliased_to)
         user.aliased_to = None
-        user.save()
     return user
 
 
@@ -63,3 +63,38 @@ class ExternalUserMiddleware(object):
             return HttpResponseRedirect(exception.request_access_url) #TODO: consider other possibilities
 
         # Remember to persist some of the session data after 'confirm' login (e.g. 'login service')
+
+
+class AbuseMiddleware(object):
+    # Must come before the session and authentication middlewares, so
+    # failures they see can be attributed to the client's address. Locked
+    # out addresses are only refused logins, by the authentication backend.
+    def process_request(self, request):
+        abuse.set_client_addr(abuse.trusted_addr(request))
+
+    def process_response(self, request, response):
+        abuse.set_client_addr(None)
+        return response
+
+
+class DeferredWritesMiddleware(object):
+    # Queues the request's deferred writes as one task before the response
+    # is returned, which on App Engine is sooner than request_finished.
+    def process_response(self, request, response):
+        deferred.flush()
+        return response
+
+
+class IdentityMapMiddleware(object):
+    # Must come before the authentication middleware, so that every fetch
+    # in the request goes through the map. request.identity_map.saved
+    # counts the calls it answered.
+    def process_request(self, request):
+        request.identity_map = identity.begin()
+
+    def process_response(self, request, response):
+        m = identity.current()
+        if m is not None and settings.DEBUG:
+            response['X-Identity-Map-Saved'] = str(m.saved)
+        identity.end()
+        return response
@@ -5,7 +5,8 @@ from django.conf import settings
 from django.contrib.auth.models import User as _User, UNUSABLE_PASSWORD, AnonymousUser
 from django.core.exceptions import ImproperlyConfigured
 
-from .utils import urlquote, cache, FUTURE_DATETIME, DEGIDDE
+from .identity import mapped, mapped_async, saves, removes, forgets
+from .utils import urlquote, cache, retry, Encoder, Future, FUTURE_DATETIME, DEGIDDE
 from .services import get_service
 
 
@@ -14,20 +15,131 @@ SUPERUSER_RANKS = ('_superuser',)
 STAFF_RANKS = ('_staff',) + SUPERUSER_RANKS
 USER_URL_FORMAT = conf.get('USER_URL_FORMAT', '/users/%s')
 USER_CACHE_TIMEOUT = conf.get('USER_CACHE_TIMEOUT', 0)
+USER_CACHE_STALE = conf.get('USER_CACHE_STALE') # seconds a stale user may be served
+USER_CACHE_LOCAL = conf.get('USER_CACHE_LOCAL') # users also kept in process
+USER_CACHE_NEGATIVE = conf.get('USER_CACHE_NEGATIVE') # seconds a missing user is cached
+ALIAS_CACHE_TIMEOUT = conf.get('ALIAS_CACHE_TIMEOUT', 86400)
+ALIAS_CACHE_NEGATIVE = conf.get('ALIAS_CACHE_NEGATIVE', 3600)
+PERMISSION_CACHE_LOCAL = conf.get('PERMISSION_CACHE_LOCAL') # groups also kept in process
+CACHE_LOCAL_CHECK = conf.get('CACHE_LOCAL_CHECK', 1) # seconds in-process entries may lag
+INSERT_RETRIES = conf.get('INSERT_RETRIES', 3) # retries of contended inserts
+INSERT_BACKOFF = conf.get('INSERT_BACKOFF', 0.01) # seconds, doubled on each retry
 USER_CONFIRM_EXTERNAL = conf.get('USER_CONFIRM_EXTERNAL', False)
 
 
 _get_full_name = operator.attrgetter('full_name')
 
+from .permissions import invalidates # needs conf
+
 
 def validate_permission(username, group, perm):
-    if not (group in conf.get('GROUPS', ())
+    if group and not (group in conf.get('GROUPS', ())
         or group in SUPERUSER_RANKS or group in STAFF_RANKS):
         raise ValueError("Invalid group %s" % group)
     if perm not in conf.get('PERMISSIONS', ()):
         raise ValueError("Invalid permission %s" % perm)
 
 
+class PermissionBase(object):
+    # Wired like UserBase, over get_by_key_name, get_by_key_name_async,
+    # put and _put_async, and _prefix_query, _remove_prefix and
+    # _list_async for the permissions of a user or group.
+    _group_pre = u'@'
+    _perm_pre = u'/'
+
+    @classmethod
+    def _make_key_name(cls, username, group, perm):
+        if group:
+            start = cls._group_pre + group
+        else:
+            start = username # There must be a username
+        return start + cls._perm_pre + (perm or '')
+
+    @classmethod
+    def parse_key_name(cls, key_name):
+        start, perm = key_name.split(cls._perm_pre, 1)
+        username = group = None
+        if start.startswith(cls._group_pre):
+            group = start[1:]
+        else:
+            username = start
+        return username, group, perm or None
+
+    _cache_key = lambda cls, group, perm=None: not perm and group
+    @cache(_cache_key, namespace='Permission', local=PERMISSION_CACHE_LOCAL,
+           local_check=CACHE_LOCAL_CHECK)
+    def fetch_by_group(cls, group, perm=None):
+        r = cls.fetch(None, perm, _group=group)
+        if perm:
+            return r
+        return list(r) # cache the entities, not the query
+
+    save = saves('Permission', lambda self: self.key().name())(
+        invalidates(lambda self: self.group)(
+            fetch_by_group.invalidate(lambda self: self.group)(lambda self: self.put())))
+
+    # Like db.put_async, the result must be waited for, here so that the
+    # caches are invalidated.
+    def save_async(self):
+        return self._put_async().then(self._put_done)
+
+    _put_done = saves('Permission', lambda self, key: key.name())(
+        invalidates(lambda self, key: self.group)(
+            fetch_by_group.invalidate(lambda self, key: self.group)(lambda self, key: key)))
+
+    @invalidates(lambda cls, group, perm=None: group)
+    @fetch_by_group.invalidate(lambda cls, group, perm=None: group)
+    def remove_by_group(cls, group, perm=None):
+        return cls.remove(None, perm, _group=group)
+
+    fetch_by_group = classmethod(fetch_by_group)
+    remove_by_group = classmethod(remove_by_group)
+
+    @classmethod
+    @forgets('Permission', lambda cls, username, perm=None, _group=None: None,
+             drop=('Permission',))
+    @invalidates(lambda cls, username, perm=None, _group=None: None)
+    def remove(cls, username, perm=None, _group=None):
+        if not (username or _group):
+            return
+        key = cls._make_key_name(username, _group, perm)
+        if perm:
+            cls.delete_by_key_name(key)
+        else:
+            cls._remove_prefix(key)
+
+    # Only single permissions are mapped, queries are not.
+    _map_key = lambda cls, username, perm=None, _group=None: \
+        perm and (username or _group) and cls._make_key_name(username, _group, perm)
+
+    @classmethod
+    @mapped('Permission', _map_key)
+    def fetch(cls, username, perm=None, _group=None):
+        if not (username or _group):
+            return ()
+        key = cls._make_key_name(username, _group, perm)
+        if perm:
+            return cls.get_by_key_name(key)
+        return cls._prefix_query(key)
+
+    @classmethod
+    @mapped_async('Permission', _map_key)
+    def fetch_async(cls, username, perm=None, _group=None):
+        if not (username or _group):
+            return Future(result=())
+        key = cls._make_key_name(username, _group, perm)
+        if perm:
+            return cls.get_by_key_name_async(key)
+        return cls._list_async(cls._prefix_query(key))
+
+    @classmethod
+    def fetch_many(cls, username, perms, _group=None):
+        if not (username or _group):
+            return [None] * len(perms)
+        return cls.get_by_key_name([cls._make_key_name(username, _group, perm)
+                                    for perm in perms])
+
+
 class UserBase(_User):
     #def __init__(self, *args, **kwargs):
         # Cleaning the email is mainly the task of the form
@@ -71,6 +183,19 @@ class UserBase(_User):
             r['inactive'] = inactive
         return r
 
+    def set_password(self, raw_password):
+        from .hashers import make_password
+
+        self.password = make_password(raw_password)
+
+    def check_password(self, raw_password):
+        from .hashers import check_password
+
+        r = check_password(raw_password, self.password)
+        if r is None: # hashed before PBKDF2, by Django
+            r = super(UserBase, self).check_password(raw_password)
+        return r
+
     def validate(self):
         if not self.is_validated():
             self.date_validated = datetime.datetime.now()
@@ -96,6 +221,155 @@ class UserBase(_User):
         raise NotImplementedError
     get_and_delete_messages = get_profile
 
+    # The caches and the identity map are wired here, over what the
+    # backends store: get_by_key_name, get_by_key_name_async,
+    # delete_by_key_name, put and _put_async for User and UserAlias, and
+    # _insert, _insert_async, _by_email, _first_async and _commit_aliases.
+    def fetch(cls, username):
+        return cls.get_by_key_name(username)
+
+    def fetch_many(cls, usernames):
+        # One batched get, in order, with None for missing users.
+        return cls.get_by_key_name(list(usernames))
+
+    def fetch_async(cls, username):
+        return cls.get_by_key_name_async(username)
+
+    def remove(cls, username):
+        cls.delete_by_key_name(username)
+
+    def save(self, force_insert=False):
+        if force_insert and self._username:
+            return self._insert()
+        self.put()
+        return self
+
+    # Like db.put_async, the result must be waited for, here so that the
+    # cache is invalidated.
+    def save_async(self, force_insert=False):
+        if force_insert and self._username:
+            return self._insert_async().then(self._inserted)
+        return self._put_async().then(self._put_done)
+
+    def _inserted(self, saved):
+        return saved
+
+    def _put_done(self, key):
+        return self
+
+    if USER_CACHE_TIMEOUT:
+        _cache_key = lambda cls, username: username
+        fetch = cache(_cache_key, timeout=USER_CACHE_TIMEOUT, namespace='User',
+                      negative_timeout=USER_CACHE_NEGATIVE, stale=USER_CACHE_STALE,
+                      local=USER_CACHE_LOCAL, local_check=CACHE_LOCAL_CHECK)(fetch)
+        save = fetch.invalidate(lambda self, force_insert=False: self.username)(save)
+        _inserted = fetch.invalidate(lambda self, saved: self.username)(_inserted)
+        _put_done = fetch.invalidate(lambda self, key: self.username)(_put_done)
+        remove = fetch.invalidate(_cache_key)(remove)
+        fetch_many = fetch.many(fetch_many)
+        fetch_async = fetch.future(fetch_async)
+    # The request's identity map comes before the cache. Any write may
+    # change an email, so it drops the mapped email lookups.
+    fetch = mapped('User', lambda cls, username: username)(fetch)
+    fetch_async = mapped_async('User', lambda cls, username: username)(fetch_async)
+    save = saves('User', lambda self, force_insert=False: self.username,
+                 drop=('User.email',))(save)
+    _inserted = saves('User', lambda self, saved: self.username, drop=('User.email',))(_inserted)
+    _put_done = saves('User', lambda self, key: self.username, drop=('User.email',))(_put_done)
+    remove = removes('User', lambda cls, username: username, drop=('User.email',))(remove)
+    fetch = classmethod(fetch)
+    fetch_many = classmethod(fetch_many)
+    fetch_async = classmethod(fetch_async)
+    remove = classmethod(remove)
+
+    @classmethod
+    @mapped('User.email', lambda cls, email, first=True: first and email,
+            entity=('User', lambda user: user.username))
+    def fetch_by_email(cls, email, first=True):
+        query = cls._by_email(email)
+        if first:
+            return query.get()
+        return query
+
+    @classmethod
+    @mapped_async('User.email', lambda cls, email, first=True: first and email,
+                  entity=('User', lambda user: user.username))
+    def fetch_by_email_async(cls, email, first=True):
+        query = cls._by_email(email)
+        if not first:
+            return Future(result=query)
+        return cls._first_async(query)
+
+    def _alias_target(cls, alias):
+        alias = models.UserAlias.get_by_key_name(alias)
+        if alias:
+            return alias.username
+
+    def _alias_target_async(cls, alias):
+        return models.UserAlias.get_by_key_name_async(alias).then(
+            lambda alias: alias.username if alias else None)
+
+    def save_alias(self, alias):
+        models.UserAlias(key_name=alias, username=self.username).put()
+
+    def remove_alias(self, alias):
+        models.UserAlias.delete_by_key_name(alias)
+
+    if ALIAS_CACHE_TIMEOUT:
+        _alias_target = cache(lambda cls, alias: alias, timeout=ALIAS_CACHE_TIMEOUT,
+                              namespace='UserAlias',
+                              negative_timeout=ALIAS_CACHE_NEGATIVE)(_alias_target)
+        save_alias = _alias_target.invalidate(lambda self, alias: alias)(save_alias)
+        remove_alias = _alias_target.invalidate(lambda self, alias: alias)(remove_alias)
+        _alias_target_async = _alias_target.future(_alias_target_async)
+    _alias_target = mapped('UserAlias', lambda cls, alias: alias)(_alias_target)
+    _alias_target_async = mapped_async('UserAlias', lambda cls, alias: alias)(_alias_target_async)
+    save_alias = forgets('UserAlias', lambda self, alias: alias)(save_alias)
+    remove_alias = forgets('UserAlias', lambda self, alias: alias)(remove_alias)
+    _alias_target = classmethod(_alias_target)
+    _alias_target_async = classmethod(_alias_target_async)
+
+    @classmethod
+    def fetch_by_alias(cls, alias):
+        username = cls._alias_target(alias)
+        if username:
+            return cls.fetch(username)
+
+    @classmethod
+    def fetch_by_alias_async(cls, alias):
+        # The user can only be fetched once the alias is resolved.
+        return cls._alias_target_async(alias).then(
+            lambda username: cls.fetch(username) if username else None)
+
+    @classmethod
+    @forgets('UserAlias', lambda cls, alias, username: alias)
+    def prime_alias(cls, alias, username):
+        # Makes an alias that is yet to be saved resolve; only a cache write.
+        if ALIAS_CACHE_TIMEOUT:
+            cls._alias_target.prime(username, cls, alias)
+
+    @classmethod
+    def commit_aliases(cls, aliases):
+        '''
+        Saves {username: alias} pairs in batches, and clears aliased_to of
+        the users whose aliased_to still holds the same alias. Running it
+        again does no harm.
+        '''
+        cls._commit_aliases(aliases)
+        for username, alias in aliases.items():
+            cls._forget(username, alias)
+
+    def _forget(cls, username, alias):
+        pass
+
+    if USER_CACHE_TIMEOUT:
+        _forget = fetch.__func__.invalidate(lambda cls, username, alias: username)(_forget)
+    if ALIAS_CACHE_TIMEOUT:
+        _forget = _alias_target.__func__.invalidate(lambda cls, username, alias: alias)(_forget)
+    _forget = forgets('User', lambda cls, username, alias: username)(
+        forgets('UserAlias', lambda cls, username, alias: alias)(_forget))
+    _forget = classmethod(_forget)
+
 
 class Error(Exception):
     pass
@@ -112,9 +386,10 @@ class UsernameTakenError(Error):
 def _external_property(name):
     def getter(self):
         if not hasattr(self, '_user_cache'):
-            #optimized for current user, cached in session, etc...
-            self._user_cache = self.service.get_user(self.id)
-        return self._user_cache.get(name)
+            from .profiles import get_profile
+            # Cached in the session and the shared cache, see profiles.
+            self._user_cache = get_profile(self)
+        return (self._user_cache or {}).get(name)
     getter.__name__ = name
     return property(getter)
 
@@ -198,19 +473,37 @@ class ExternalUser(AnonymousUser):
 
     @classmethod
     def fetch(cls, id=None, service=None):
+        profile = None
         if not id:
             try:
-                id = service.get_user()["id"]
-            except AttributeError:
+                profile = service.get_user()
+                id = profile["id"]
+            except (AttributeError, TypeError):
                 raise TypeError
  
         u = cls(id)
+        if profile is not None:
+            from .profiles import remember
+            # No need to ask the service again.
+            u._user_cache = profile
+            remember(u, profile)
         if service:
             u._service = service
             if service.is_email_service:
                 u.validate()
         return u
 
+    @classmethod
+    def fetch_many(cls, ids, service):
+        '''
+        External users of `service` with their profiles loaded, in batches.
+        '''
+        from .profiles import prefetch
+
+        users = [cls.fetch(id, service) for id in ids]
+        prefetch(users)
+        return users
+
     @property
     def service(self):
         if not self._service:
@@ -292,3 +585,30 @@ Session = models.Session
 User = models.User
 Permission = models.Permission
 dump = models.dump
+
+
+def migrate_aliases(batch_size=500, deadline=None, cursor=None):
+    '''
+    Moves aliases still kept in User.aliased_to to UserAlias entities,
+    until none are left or `deadline` seconds have passed. Pass the returned
+    cursor back to resume.
+    '''
+    import time
+
+    start = time.time()
+    migrated = batches = 0
+    more = True
+    while more and (deadline is None or time.time() - start < deadline):
+        n, cursor, more = User.migrate_aliases(batch_size, cursor)
+        migrated += n
+        batches += 1
+    return {
+        'migrated': migrated,
+        'batches': batches,
+        'seconds': time.time() - start,
+        'cursor': more and cursor or None,
+    }
+
+# Users are the most common objects in responses, skip resolving them.
+Encoder.register(UserBase, UserBase.dump.__func__)
+Encoder.register(ExternalUser, ExternalUser.dump.__func__)
@@ -0,0 +1,104 @@
+import functools
+import operator
+import time
+from functools import reduce
+
+from .models import conf
+from .utils import bump_generation
+
+
+GENERATION_KEY = __name__ + ':gen'
+CHECK_INTERVAL = conf.get('PERMISSION_CHECK_INTERVAL', 10)
+
+
+class PermissionTable(object):
+    # Permissions are fixed in settings, so each one gets a bit, and sets of
+    # permissions become integer masks.
+    def __init__(self, perms):
+        self.perms = tuple(perms)
+        self.bits = dict((p, 1 << i) for i, p in enumerate(self.perms))
+        self.all = (1 << len(self.perms)) - 1
+
+    def bit(self, perm):
+        return self.bits.get(perm, 0)
+
+    def mask(self, perms):
+        '''
+        Returns None if any of the permissions is unknown.
+        '''
+        try:
+            return reduce(operator.or_, (self.bits[p] for p in perms), 0)
+        except KeyError:
+            return None
+
+    def names(self, mask):
+        return frozenset(p for p in self.perms if mask & self.bits[p])
+
+
+table = PermissionTable(conf.get('PERMISSIONS', ()))
+
+
+# Every Permission write bumps a global generation in the shared cache, and
+# group writes also bump the group's own one. Processes poll the global
+# generation and, when it moves, compare the group generations to find
+# which of their cached groups must be rebuilt.
+def _group_key(group):
+    return GENERATION_KEY + ':' + group
+
+
+def changed(group=None):
+    if group:
+        bump_generation(_group_key(group))
+    bump_generation(GENERATION_KEY)
+
+
+def invalidates(group_func):
+    # Must wrap the shared cache invalidation, so other processes never
+    # rebuild a group from a value that is about to be deleted.
+    def decorator(func):
+        @functools.wraps(func)
+        def w(*args, **kwargs):
+            r = func(*args, **kwargs)
+            changed(group_func(*args, **kwargs))
+            return r
+        return w
+    return decorator
+
+
+class GroupWatch(object):
+    def __init__(self, interval=CHECK_INTERVAL):
+        self.interval = interval
+        self.gens = {} # group -> generation its cached value was built at
+        self._gen = None
+        self._checked = 0
+
+    def check(self, groups):
+        '''
+        Drops the groups changed elsewhere from the `groups` mapping. At most
+        one cache read every `interval` seconds, two when something changed.
+        '''
+        from django.core.cache import cache as _cache
+
+        now = time.time()
+        if now - self._checked < self.interval:
+            return
+        self._checked = now
+        gen = _cache.get(GENERATION_KEY)
+        if gen == self._gen:
+            return
+        self._gen = gen
+        cached = [g for g in list(groups) if g]
+        gens = _cache.get_many([_group_key(g) for g in cached]) if cached else {}
+        for g in cached:
+            if gens.get(_group_key(g)) != self.gens.get(g):
+                groups.pop(g, None)
+
+    def generation(self, group):
+        from django.core.cache import cache as _cache
+
+        if group:
+            return _cache.get(_group_key(group))
+
+    def built(self, group, gen):
+        if group:
+            self.gens[group] = gen
@@ -0,0 +1,105 @@
+import time
+
+from .models import conf
+from .services import UNCHANGED
+
+
+TIMEOUT = conf.get('PROFILE_CACHE_TIMEOUT', 86400)
+REFRESH = conf.get('PROFILE_REFRESH', 900) # seconds before asking if it changed
+SESSION_KEY = '_degidde_profile'
+
+
+# External profiles are kept, as (profile, checked at), in the shared cache
+# and in the session of their user. Past REFRESH seconds they are
+# revalidated with the service's get_user_if_changed, which costs less
+# than fetching them again when they haven't changed.
+def _cache_key(id):
+    return __name__ + ':' + id
+
+
+def _session(user):
+    request = getattr(user, '_request', None)
+    return getattr(request, 'session', None)
+
+
+def _store(user, entry, session=True):
+    from django.core.cache import cache
+
+    cache.set(_cache_key(user._id), entry, TIMEOUT)
+    s = _session(user) if session else None
+    if s is not None:
+        s[SESSION_KEY] = (user._id,) + entry
+
+
+def _forget(user):
+    from django.core.cache import cache
+
+    cache.delete(_cache_key(user._id))
+    s = _session(user)
+    if s is not None and (s.get(SESSION_KEY) or (None,))[0] == user._id:
+        del s[SESSION_KEY]
+
+
+def remember(user, profile):
+    _store(user, (profile, time.time()), session=False)
+
+
+def get_profile(user):
+    '''
+    The profile of an ExternalUser, from the session, the shared cache or
+    its service, in that order.
+    '''
+    from django.core.cache import cache
+
+    entry = None
+    s = _session(user)
+    if s is not None:
+        stored = s.get(SESSION_KEY)
+        if stored and stored[0] == user._id:
+            entry = stored[1:]
+    in_session = entry is not None
+    if entry is None:
+        entry = cache.get(_cache_key(user._id))
+    now = time.time()
+    if entry is None:
+        entry = (user.service.get_user(user._id), now)
+    elif now - entry[1] >= REFRESH:
+        profile = user.service.get_user_if_changed(user._id, entry[0])
+        if profile is None: # gone from the service
+            _forget(user)
+            return None
+        entry = (entry[0] if profile is UNCHANGED else profile, now)
+    elif in_session:
+        return entry[0]
+    if entry[0] is not None:
+        _store(user, entry)
+    return entry[0]
+
+
+def prefetch(users):
+    '''
+    Loads the profiles of several ExternalUsers, with one get_many and one
+    get_users call per service for those that aren't cached. Users without
+    a service yet are left to load theirs from their request.
+    '''
+    from django.core.cache import cache
+
+    users = [u for u in users if u._service and not hasattr(u, '_user_cache')]
+    cached = cache.get_many([_cache_key(u._id) for u in users]) if users else {}
+    now = time.time()
+    missing = {} # service class -> (service, users)
+    for u in users:
+        entry = cached.get(_cache_key(u._id))
+        if entry is not None and now - entry[1] < REFRESH:
+            u._user_cache = entry[0]
+        else:
+            missing.setdefault(type(u.service), (u.service, []))[1].append(u)
+    fetched = {}
+    for service, group in missing.values():
+        for u, profile in zip(group, service.get_users([u._id for u in group])):
+            u._user_cache = profile
+            if profile is not None:
+                fetched[_cache_key(u._id)] = (profile, now)
+    if fetched:
+        cache.set_many(fetched, TIMEOUT)
+    return users
@@ -1,6 +1,7 @@
 
 
 LOGIN_SERVICE = '_degidde_login_service'
+UNCHANGED = object() # returned by get_user_if_changed
 
 
 def get_service(service_name, _mod_prefix='degidde.services.'): #use relative import?
@@ -19,4 +20,20 @@ def is_logged_out():
 
 
 class ServiceBase(object):
-    pass
+    def get_user(self, id=None):
+        raise NotImplementedError
+
+    def get_users(self, ids):
+        '''
+        Profiles of several users, in the order of `ids`, None for unknown
+        ones. Services whose API has a bulk call should override this.
+        '''
+        return [self.get_user(id) for id in ids]
+
+    def get_user_if_changed(self, id, profile):
+        '''
+        Returns UNCHANGED if `profile` is still current, else the current
+        profile, None if the user is gone. Services that can ask cheaply,
+        e.g. with an ETag or updated_time, should override this.
+        '''
+        return self.get_user(id)
@@ -0,0 +1,34 @@
+import collections
+
+from . import ServiceBase, UNCHANGED
+
+
+class LocalService(ServiceBase):
+    '''
+    An in-process identity provider, for tests and development. Profiles
+    are dicts with an "id", and optionally an "updated_time" that
+    get_user_if_changed compares.
+    '''
+    profiles = {}
+    calls = collections.Counter() # get_user, get_users, get_user_if_changed
+
+    def __init__(self, request=None, user_id=None):
+        self.request = request
+        self.user_id = user_id
+        self.is_email_service = False
+
+    def get_user(self, id=None):
+        self.calls['get_user'] += 1
+        profile = self.profiles.get(id or self.user_id)
+        return profile and dict(profile)
+
+    def get_users(self, ids):
+        self.calls['get_users'] += 1
+        return [self.profiles.get(id) and dict(self.profiles[id]) for id in ids]
+
+    def get_user_if_changed(self, id, profile):
+        self.calls['get_user_if_changed'] += 1
+        current = self.profiles.get(id)
+        if current is None or current.get('updated_time') != profile.get('updated_time'):
+            return current and dict(current)
+        return UNCHANGED
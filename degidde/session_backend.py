@@ -1,30 +1,83 @@
+import collections
 import datetime
+import random
+import time
 
+from django.contrib.auth import SESSION_KEY
 from django.contrib.sessions.backends.base import SessionBase, CreateError
-from django.contrib.sessions.backends.cached_db import SessionStore as CacheStore
+from django.core.cache import cache
 from django.core.exceptions import SuspiciousOperation
-from django.utils.encoding import force_unicode
 
-from .models import Session
-from .utils import as_base_of
+from . import abuse
+from .models import Session, conf
+from .session_codec import get_codec
+from .utils import GENERATION_TIMEOUT
+
+
+# Skip writes of sessions whose data hasn't changed, and only push their
+# expiry forward once less than this fraction of the lifetime remains.
+SESSION_LAZY_SAVE = conf.get('SESSION_LAZY_SAVE', False)
+SESSION_REFRESH_FRACTION = conf.get('SESSION_REFRESH_FRACTION', 0.5)
+# Read through and write through the shared cache.
+SESSION_CACHE = conf.get('SESSION_CACHE', False)
+# Keep sessions without a logged in user in the cache only.
+SESSION_ANONYMOUS_CACHE_ONLY = SESSION_CACHE and conf.get('SESSION_ANONYMOUS_CACHE_ONLY', False)
+KEY_PREFIX = __name__ + ':'
+
+_random = random.SystemRandom()
+
+stats = collections.Counter() # writes, writes_skipped, cache_writes, cache_hits
+
+
+def _cache_timeout(expire_date):
+    return max(1, min(int((expire_date - datetime.datetime.now()).total_seconds()),
+                      GENERATION_TIMEOUT))
 
 
-@as_base_of(CacheStore)
 class SessionStore(SessionBase):
+    codec = get_codec()
+    _stored_data = _stored_expiry = None
+
+    def _fetch(self, session_key):
+        # Returns (session_data, expire_date), or None.
+        if SESSION_CACHE:
+            entry = cache.get(KEY_PREFIX + session_key)
+            if entry is not None:
+                stats['cache_hits'] += 1
+                return entry
+        s = Session.fetch(session_key)
+        if s:
+            entry = (s.session_data, s.expire_date)
+            if SESSION_CACHE:
+                cache.set(KEY_PREFIX + session_key, entry, _cache_timeout(s.expire_date))
+            return entry
+
     def load(self):
-        s = Session.fetch(self.session_key) 
-        if s and datetime.datetime.now() < s.expire_date:
+        entry = self._fetch(self.session_key)
+        if entry and datetime.datetime.now() < entry[1]:
             try:
-                return self.decode(force_unicode(s.session_data))
+                data = self.codec.decode(self, entry[0])
+                # Pickles of equal sessions can differ, e.g. when stored
+                # by another codec, so _unchanged compares what save would
+                # write for the session as loaded.
+                if SESSION_LAZY_SAVE:
+                    self._stored_data = self.codec.encode(self, data)
+                    self._stored_expiry = entry[1]
+                return data
             except SuspiciousOperation:
-                # TODO: this looks like the place to throttle
-                # against an attempt trying to guess a valid session cookie
-                pass
+                # Possibly an attempt at guessing a valid session cookie.
+                abuse.bad_session()
         self.create()
         return {}
 
     def exists(self, session_key):
-        return bool(Session.fetch(session_key))
+        return bool(self._fetch(session_key))
+
+    def _get_new_session_key(self):
+        # Unlike Django's, this doesn't check that the key is free: saving
+        # with must_create is atomic and raises CreateError on a collision,
+        # so the extra read is wasted.
+        return '%032x' % _random.getrandbits(128)
 
     def create(self):
         while True:
@@ -37,20 +90,76 @@ class SessionStore(SessionBase):
             self._session_cache = {}
             return
 
+    def _unchanged(self, data, expire_date):
+        if data != self._stored_data or self._stored_expiry is None:
+            return False
+        now = datetime.datetime.now()
+        remaining = (self._stored_expiry - now).total_seconds()
+        return remaining >= (expire_date - now).total_seconds() * SESSION_REFRESH_FRACTION
+
     def save(self, must_create=False):
-        obj = Session(
-            session_key=self.session_key,
-            session_data=self.encode(self._get_session(no_load=must_create)),
-            expire_date=self.get_expiry_date()
-        )
-        saved = obj.save(force_insert=must_create)
-        if not saved:
-            raise CreateError
+        session = self._get_session(no_load=must_create)
+        data = self.codec.encode(self, session)
+        expire_date = self.get_expiry_date()
+        if SESSION_LAZY_SAVE and not must_create and self._unchanged(data, expire_date):
+            stats['writes_skipped'] += 1
+            return
+        key = KEY_PREFIX + self.session_key
+        entry = (data, expire_date)
+        if SESSION_ANONYMOUS_CACHE_ONLY and SESSION_KEY not in session:
+            if must_create:
+                if not cache.add(key, entry, _cache_timeout(expire_date)):
+                    raise CreateError
+            else:
+                cache.set(key, entry, _cache_timeout(expire_date))
+            stats['cache_writes'] += 1
+        else:
+            obj = Session(
+                session_key=self.session_key,
+                session_data=data,
+                expire_date=expire_date
+            )
+            saved = obj.save(force_insert=must_create)
+            if not saved:
+                raise CreateError
+            stats['writes'] += 1
+            if SESSION_CACHE:
+                cache.set(key, entry, _cache_timeout(expire_date))
+        self._stored_data, self._stored_expiry = entry
 
     def delete(self, session_key=None):
         if session_key is None:
             if self._session_key is None:
                 return
             session_key = self._session_key
+        if SESSION_CACHE:
+            cache.delete(KEY_PREFIX + session_key)
         Session.remove(session_key)
 
+
+def purge_expired(batch_size=500, deadline=None, cursor=None, backlog_limit=1000,
+                  scan=False):
+    '''
+    Deletes expired sessions in batches, until none are left or `deadline`
+    seconds have passed. Pass the returned cursor back to resume, with the
+    same `scan`. With `scan`, all sessions are checked, which also finds
+    the ones saved before expire_date was indexed.
+    '''
+    purge = Session.purge_unindexed if scan else Session.purge_expired
+    now = datetime.datetime.now()
+    start = time.time()
+    deleted = batches = 0
+    more = True
+    while more and (deadline is None or time.time() - start < deadline):
+        n, cursor, more = purge(batch_size, cursor, now)
+        deleted += n
+        batches += 1
+    seconds = time.time() - start
+    return {
+        'deleted': deleted,
+        'batches': batches,
+        'seconds': seconds,
+        'per_second': seconds and deleted / seconds,
+        'remaining': more and Session.count_expired(backlog_limit, now) or 0,
+        'cursor': more and cursor or None,
+    }
@@ -0,0 +1,71 @@
+import hashlib
+import hmac
+import zlib
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousOperation
+from django.utils.encoding import force_unicode
+
+from .models import conf
+
+
+COMPRESS_THRESHOLD = conf.get('SESSION_COMPRESS_THRESHOLD', 512)
+
+# Binary rows start with a version byte, which never occurs at the start
+# of Django's base64 encoding, so both kinds of rows can be read.
+PICKLE = b'\x01'
+PICKLE_ZLIB = b'\x02'
+MAC_SIZE = 20
+
+
+def _mac(payload):
+    return hmac.new(settings.SECRET_KEY, payload, hashlib.sha1).digest()
+
+
+class LegacyCodec(object):
+    # Django's own base64 pickle with its hash. Rows written by BinaryCodec
+    # are read too, so switching back to this codec loses no sessions.
+    def encode(self, store, session):
+        return store.encode(session)
+
+    def decode(self, store, data):
+        data = bytes(data)
+        version = data[:1]
+        if version not in (PICKLE, PICKLE_ZLIB):
+            try:
+                return store.decode(force_unicode(data))
+            except UnicodeDecodeError:
+                raise SuspiciousOperation("Session data corrupted")
+        mac, payload = data[1:1 + MAC_SIZE], data[1 + MAC_SIZE:]
+        if not hmac.compare_digest(mac, _mac(payload)):
+            raise SuspiciousOperation("Session data corrupted")
+        if version == PICKLE_ZLIB:
+            payload = zlib.decompress(payload)
+        return pickle.loads(payload)
+
+
+class BinaryCodec(LegacyCodec):
+    # version byte | HMAC-SHA1 of the payload | pickle, zlib'ed above a size
+    def __init__(self, compress_threshold=COMPRESS_THRESHOLD, level=6):
+        self.compress_threshold = compress_threshold
+        self.level = level
+
+    def encode(self, store, session):
+        payload = pickle.dumps(session, pickle.HIGHEST_PROTOCOL)
+        version = PICKLE
+        if self.compress_threshold is not None and len(payload) >= self.compress_threshold:
+            compressed = zlib.compress(payload, self.level)
+            if len(compressed) < len(payload):
+                payload, version = compressed, PICKLE_ZLIB
+        return version + _mac(payload) + payload
+
+
+def get_codec(path=conf.get('SESSION_CODEC', 'degidde.session_codec.LegacyCodec')):
+    from importlib import import_module
+
+    modname, _, clsname = path.rpartition('.')
+    return getattr(import_module(modname), clsname)()
@@ -1,9 +1,22 @@
 import collections
 import datetime
 import functools
+import heapq
+import math
+import operator
+import os
+import Queue
+import random
+import sys
+import threading
 import time
 import urllib
 import urlparse
+from json import JSONEncoder
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 from django.utils.encoding import smart_str
 from django.http import HttpResponseRedirect
@@ -21,6 +34,11 @@ def as_base_of(sub):
             __doc__=cls.__doc__))
 
 
+def on_app_engine():
+    # Not the development server, which doesn't strip App Engine's headers.
+    return os.environ.get('SERVER_SOFTWARE', '').startswith('Google App Engine/')
+
+
 def urlquote(s):
     return urllib.quote(smart_str(s))
 
@@ -40,6 +58,74 @@ def same_origin_redirect(request, redirect_to, origin=None):
         return HttpResponseRedirect(redirect_to)
 
 
+def retry(func, exceptions, retries=3, backoff=0.01):
+    # Exponential backoff, with jitter so contending callers spread out.
+    for attempt in range(retries):
+        try:
+            return func()
+        except exceptions:
+            time.sleep(backoff * 2 ** attempt * random.random())
+    return func()
+
+
+class Future(object):
+    '''
+    A result started ahead of when it is needed. `wait`, e.g. an RPC's
+    get_result, is called once, by the first get_result().
+    '''
+    def __init__(self, wait=None, result=None):
+        self._wait = wait
+        self._result = result
+
+    def get_result(self):
+        if self._wait is not None:
+            wait, self._wait = self._wait, None
+            self._result = wait()
+        return self._result
+
+    def then(self, func):
+        return Future(lambda: func(self.get_result()))
+
+
+class WorkerPool(object):
+    '''
+    For backends without async calls: start() runs a call on one of a few
+    long-lived threads, which keep their per-thread state, e.g. connections.
+    '''
+    def __init__(self, size=4):
+        self.size = size
+        self.calls = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _work(self):
+        while True:
+            func, args, kwargs, done, box = self.calls.get()
+            try:
+                box.append((func(*args, **kwargs), None))
+            except Exception as e:
+                box.append((None, e))
+            done.set()
+
+    def start(self, func, *args, **kwargs):
+        if len(self._threads) < self.size:
+            with self._lock:
+                while len(self._threads) < self.size:
+                    t = threading.Thread(target=self._work)
+                    t.daemon = True
+                    t.start()
+                    self._threads.append(t)
+        done, box = threading.Event(), []
+        self.calls.put((func, args, kwargs, done, box))
+        def wait():
+            done.wait()
+            result, error = box[0]
+            if error is not None:
+                raise error
+            return result
+        return Future(wait)
+
+
 def invalid_csrf_token(request, csrf_token):
     from django.middleware.csrf import CsrfViewMiddleware, REASON_BAD_TOKEN, REASON_NO_CSRF_COOKIE
     # TODO: this doesn't handle the the referer check for https.
@@ -53,33 +139,294 @@ def invalid_csrf_token(request, csrf_token):
         return CsrfViewMiddleware()._reject(request, REASON_BAD_TOKEN)
         
 
-def cache(key_func, timeout=None, namespace=None, 
-          _force_set=False, _namespace_sep=':'):
-    from django.core import cache as _cache
+GENERATION_TIMEOUT = 29 * 86400 # memcached reads more than 30 days as a timestamp
+
+
+def bump_generation(key, timeout=GENERATION_TIMEOUT):
+    from django.core.cache import cache as _cache
+
+    try:
+        return _cache.incr(key)
+    except ValueError:
+        if _cache.add(key, 1, timeout):
+            return 1
+        return _cache.incr(key)
+
+
+_local_tiers = {} # namespace prefix -> _LocalTier, shared by a function and its invalidate
+
+
+class _LocalTier(object):
+    def __init__(self, gen_key, size, check, timeout=None):
+        self.gen_key = gen_key
+        self.check = check
+        self.entries = ExpireDict(timeout=timeout, max_entries=size)
+        self._gen = None
+        self._checked = 0
+
+    def _refresh(self):
+        from django.core.cache import cache as _cache
+
+        now = time.time()
+        if now - self._checked < self.check:
+            return
+        self._checked = now
+        gen = _cache.get(self.gen_key)
+        if gen != self._gen:
+            self.entries.clear()
+            self._gen = gen
+
+    # Values are kept pickled, like LocMemCache does, so that concurrent
+    # requests never share (and mutate) the same entity instance.
+    def get(self, key):
+        self._refresh()
+        data = self.entries.get(key)
+        if data is not None:
+            return pickle.loads(data)
+
+    def set(self, key, data, timeout=None):
+        self.entries.set(key, pickle.dumps(data, pickle.HIGHEST_PROTOCOL), timeout)
+
+    def bump(self, key):
+        self.entries.pop(key, None)
+        old, self._gen = self._gen, bump_generation(self.gen_key)
+        if old is None or self._gen != old + 1:
+            # Others bumped it too since the last check, for keys unknown here.
+            self.entries.clear()
+        self._checked = time.time()
+
+
+class _Missing(object):
+    # Cached in place of a None result. Pickles by reference, so the shared
+    # cache gives back this same instance.
+    def __reduce__(self):
+        return '_MISSING'
+
+_MISSING = _Missing()
+
+
+# With negative_timeout set, None results are cached too, for that many
+# seconds, as a sentinel, and reported as negative_hits.
+#
+# With stale or beta set, entries are stored as (value, soft expiry, compute
+# time) and kept in the cache for `stale` seconds past `timeout`. Once soft
+# expired, the caller that wins a cache.add lock recomputes while the others
+# are served the old value; on a hard miss the losers wait up to `wait`
+# seconds for the winner. beta enables probabilistic early refresh (XFetch),
+# which spreads recomputation of hot keys ahead of their expiry.
+#
+# With local set, up to that many values are also kept in process. Every
+# invalidate bumps a generation counter for the namespace in the shared cache,
+# and each process drops its local entries for the namespace once it sees a
+# new generation, which it checks at most every `local_check` seconds.
+def cache(key_func, timeout=None, namespace=None, negative_timeout=None, stale=None,
+          beta=None, wait=0, lock_timeout=10, local=None, local_check=1,
+          _invalidate=False, _namespace_sep=':', _lock_suffix=':lock', _poll=0.05):
+    from django.core.cache import cache as _cache
 
     _namespace = cache.__module__ + '.' + cache.__name__
+    protected = stale is not None or bool(beta)
+    hard_timeout = timeout and protected and timeout + (stale or 0) or timeout
+    negative_hard_timeout = negative_timeout and protected and \
+        negative_timeout + (stale or 0) or negative_timeout
+
     def decorator(func):
-        namespace = _namespace + _namespace_sep + namespace or func.__name__
-        functools.wraps(func)
+        ns = namespace or func.__name__
+        prefix = _namespace + _namespace_sep + ns
+        stats = collections.Counter()
+        l1 = _local_tiers.get(prefix)
+        if local and not l1:
+            l1 = _local_tiers[prefix] = _LocalTier(prefix + _namespace_sep + '#gen',
+                                                   local, local_check, timeout)
+
+        def pack(data, delta, ttl=timeout):
+            if not protected:
+                return data
+            return (data, time.time() + ttl if ttl else None, delta)
+
+        def unpack(entry):
+            if entry is None or not protected:
+                return entry, None, 0
+            return entry
+
+        def compute(key, args, kwargs):
+            started = time.time()
+            return store(key, func(*args, **kwargs), time.time() - started)
+
+        def store(key, data, delta):
+            if data is not None:
+                _cache.set(key, pack(data, delta), hard_timeout)
+            elif negative_timeout:
+                _cache.set(key, pack(_MISSING, delta, negative_timeout),
+                           negative_hard_timeout)
+            else:
+                _cache.delete(key)
+            return data
+
+        def local_set(key, data):
+            l1.set(key, data, negative_timeout if data is _MISSING else None)
+
+        def found(data):
+            if data is _MISSING:
+                stats['negative_hits'] += 1
+                return None
+            return data
+
+        @functools.wraps(func)
         def w(*args, **kwargs):
             try:
-                key = namespace + _namespace_sep + key_func(*args, **kwargs)
+                key = prefix + _namespace_sep + key_func(*args, **kwargs)
             except TypeError:
                 key = None
-            if _force_set or not key:
-                data = None
-            else:
-                data = _cache.get(key)
-            if data is None:
+            if _invalidate:
+                # Writes are wrapped by invalidate: run them, then drop the entry.
                 data = func(*args, **kwargs)
                 if key:
-                    if data is None:
-                        _cache.delete(key)
-                    else:
-                        _cache.set(key, data, timeout)
-            return data
-        w.invalidate = functools.partial(cache, timeout=timeout, namespace=namespace,
-                                         _force_set=True)
+                    _cache.delete(key)
+                    if l1:
+                        l1.bump(key)
+                return data
+            if not key:
+                return func(*args, **kwargs)
+
+            if l1:
+                data = l1.get(key)
+                if data is not None:
+                    stats['local_hits'] += 1
+                    return found(data)
+                data = shared(key, args, kwargs)
+                if data is not None:
+                    local_set(key, data)
+                return found(data)
+            return found(shared(key, args, kwargs))
+
+        def shared(key, args, kwargs):
+            data, expires, delta = unpack(_cache.get(key))
+            now = time.time()
+            expired = expires is not None and expires <= now
+            if data is not None and not expired:
+                # Without a timeout nothing expires, so nothing is refreshed early.
+                if not (beta and expires is not None
+                        and now - delta * beta * math.log(1.0 - random.random()) >= expires):
+                    stats['hits'] += 1
+                    return data
+                stats['early'] += 1
+            else:
+                stats['misses'] += 1
+            if not protected:
+                return compute(key, args, kwargs)
+
+            lock = key + _lock_suffix
+            if _cache.add(lock, 1, lock_timeout):
+                try:
+                    return compute(key, args, kwargs)
+                finally:
+                    _cache.delete(lock)
+            stats['contention'] += 1
+            if data is not None:
+                if expired:
+                    stats['stale'] += 1
+                return data
+            deadline = now + wait
+            while time.time() < deadline:
+                time.sleep(_poll)
+                data = unpack(_cache.get(key))[0]
+                if data is not None:
+                    stats['waited'] += 1
+                    return data
+            return compute(key, args, kwargs)
+
+        w.invalidate = functools.partial(cache, timeout=timeout, namespace=ns,
+                                         _invalidate=True)
+
+        def prime(data, *args, **kwargs):
+            # Stores data as the result for these arguments, e.g. ahead of
+            # a deferred write that will make it true.
+            key = prefix + _namespace_sep + key_func(*args, **kwargs)
+            store(key, data, 0)
+            if l1:
+                l1.bump(key)
+        w.prime = prime
+        w.stats = stats
+
+        def many(func_many):
+            # func_many takes the same leading arguments as func, but a list
+            # of ids in place of the last one, and returns a list in the same
+            # order. Only the ids missing from the cache are passed on to it.
+            @functools.wraps(func_many)
+            def m(*args):
+                args, ids = args[:-1], list(args[-1])
+                keys = [prefix + _namespace_sep + key_func(*(args + (i,))) for i in ids]
+                now = time.time()
+                hits = {}
+                if l1:
+                    for k in keys:
+                        data = l1.get(k)
+                        if data is not None:
+                            hits[k] = data
+                    stats['local_hits'] += len(hits)
+                remote = [k for k in keys if k not in hits]
+                for k, entry in (_cache.get_many(remote) if remote else {}).items():
+                    data, expires, _ = unpack(entry)
+                    if data is not None and (expires is None or now < expires):
+                        hits[k] = data
+                        if l1:
+                            local_set(k, data)
+                missing = [(i, k) for i, k in zip(ids, keys) if k not in hits]
+                stats['hits'] += len(remote) - len(missing)
+                stats['misses'] += len(missing)
+                if missing:
+                    start = time.time()
+                    data = func_many(*(args + ([i for i, _ in missing],)))
+                    delta = (time.time() - start) / len(missing)
+                    fetched, absent = {}, {}
+                    for (_, k), d in zip(missing, data):
+                        if d is not None:
+                            hits[k] = d
+                            fetched[k] = pack(d, delta)
+                            if l1:
+                                l1.set(k, d)
+                        elif negative_timeout:
+                            absent[k] = pack(_MISSING, delta, negative_timeout)
+                    if fetched:
+                        _cache.set_many(fetched, hard_timeout)
+                    if absent:
+                        _cache.set_many(absent, negative_hard_timeout)
+                return [found(hits.get(k)) for k in keys]
+            return m
+        w.many = many
+
+        def future(func_async):
+            # func_async takes the same arguments as func, but returns a
+            # Future. Hits are returned as done futures, and a miss is stored
+            # when its result is read.
+            @functools.wraps(func_async)
+            def f(*args, **kwargs):
+                try:
+                    key = prefix + _namespace_sep + key_func(*args, **kwargs)
+                except TypeError:
+                    return func_async(*args, **kwargs)
+                if l1:
+                    data = l1.get(key)
+                    if data is not None:
+                        stats['local_hits'] += 1
+                        return Future(result=found(data))
+                data, expires, _ = unpack(_cache.get(key))
+                if data is not None and (expires is None or time.time() < expires):
+                    stats['hits'] += 1
+                    if l1:
+                        local_set(key, data)
+                    return Future(result=found(data))
+                stats['misses'] += 1
+                started = time.time()
+                def done(data):
+                    store(key, data, time.time() - started)
+                    if l1 and data is not None:
+                        l1.set(key, data)
+                    return data
+                return func_async(*args, **kwargs).then(done)
+            return f
+        w.future = future
         return w
     return decorator
 
@@ -102,54 +449,228 @@ def cache(key_func, timeout=None, namespace=None,
 #    return bool(m)
 
 
-class ExpireDict(collections.MutableMapping, dict):
-    def __init__(self, it=(), timeout=None):
-        dict.__init__(self, it)
+class _Stripe(object):
+    __slots__ = ('lock', 'entries', 'heap', 'bytes', 'stats')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict() # key -> (value, expires, size), LRU first
+        self.heap = [] # (expires, key), may hold outdated items
+        self.bytes = 0
+        self.stats = collections.Counter()
+
+
+class ExpireDict(collections.MutableMapping):
+    # A bounded, thread-safe LRU mapping whose entries expire `timeout`
+    # seconds after being set. Keys are spread over `stripes` independently
+    # locked segments, each holding its share of max_entries and max_bytes
+    # (measured with `sizeof`, which is shallow by default). Expired entries
+    # are swept from a heap on every write, and on reads at most every
+    # `sweep_interval` seconds, so keys that are never read again don't leak.
+    def __init__(self, it=(), timeout=None, max_entries=None, max_bytes=None,
+                 stripes=16, sizeof=sys.getsizeof, sweep_interval=1):
         self.timeout = timeout
-        self._exp = {}
-
-    __contains__ = dict.__contains__
-    __iter__ = dict.__iter__
-    __len__ = dict.__len__
-
-    def __getitem__(self, k):
-        v = dict.__getitem__(self, k)
-        e = self._exp[k]
-        if e < time.time():
-            dict.pop(self, k, None)
-            self._exp.pop(k, None)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.sweep_interval = sweep_interval
+        self._stripes = [_Stripe() for _ in range(stripes)]
+        self._stripe_entries = max_entries and -(-max_entries // stripes)
+        self._stripe_bytes = max_bytes and -(-max_bytes // stripes)
+        self._swept = 0
+        self.update(it)
+
+    def _stripe(self, k):
+        return self._stripes[hash(k) % len(self._stripes)]
+
+    def _drop(self, stripe, k, reason=None):
+        v, e, size = stripe.entries.pop(k)
+        stripe.bytes -= size
+        if reason:
+            stripe.stats[reason] += 1
+
+    def _sweep(self, stripe, now):
+        heap = stripe.heap
+        entries = stripe.entries
+        while heap and heap[0][0] <= now:
+            e, k = heapq.heappop(heap)
+            entry = entries.get(k)
+            if entry is not None and entry[1] == e:
+                self._drop(stripe, k, 'expirations')
+        # Overwrites leave outdated heap items behind, compact them now and then.
+        if len(heap) > 2 * len(entries) + 64:
+            stripe.heap = [(entry[1], k) for k, entry in entries.items()
+                           if entry[1] is not None]
+            heapq.heapify(stripe.heap)
+
+    def sweep(self, now=None):
+        now = now or time.time()
+        self._swept = now
+        for stripe in self._stripes:
+            with stripe.lock:
+                self._sweep(stripe, now)
+
+    def get(self, k, default=None):
+        stripe = self._stripe(k)
+        now = time.time()
+        # Sweep every stripe, not just this key's, so stripes that only see
+        # reads still shed their expired entries. Done before taking the
+        # stripe lock, one stripe lock at a time.
+        if now - self._swept >= self.sweep_interval:
+            self.sweep(now)
+        with stripe.lock:
+            entry = stripe.entries.pop(k, None)
+            if entry is None:
+                stripe.stats['misses'] += 1
+                return default
+            if entry[1] is not None and entry[1] <= now:
+                stripe.bytes -= entry[2]
+                stripe.stats['expirations'] += 1
+                stripe.stats['misses'] += 1
+                return default
+            stripe.entries[k] = entry
+            stripe.stats['hits'] += 1
+            return entry[0]
+
+    def __getitem__(self, k, _missing=object()):
+        v = self.get(k, _missing)
+        if v is _missing:
             raise KeyError(k)
         return v
 
-    def __setitem__(self, k, v):
-        dict.__setitem__(self, k, v)
-        self._exp[k] = time.time() + self.timeout
-        
+    def __contains__(self, k):
+        stripe = self._stripe(k)
+        with stripe.lock:
+            entry = stripe.entries.get(k)
+        return entry is not None and (entry[1] is None or time.time() < entry[1])
+
+    def set(self, k, v, timeout=None):
+        timeout = timeout or self.timeout
+        now = time.time()
+        e = timeout and now + timeout or None
+        size = self.sizeof(v) if self._stripe_bytes else 0
+        stripe = self._stripe(k)
+        with stripe.lock:
+            self._sweep(stripe, now)
+            if k in stripe.entries:
+                self._drop(stripe, k)
+            stripe.entries[k] = (v, e, size)
+            stripe.bytes += size
+            if e is not None:
+                heapq.heappush(stripe.heap, (e, k))
+            while ((self._stripe_entries and len(stripe.entries) > self._stripe_entries)
+                   or (self._stripe_bytes and stripe.bytes > self._stripe_bytes)):
+                self._drop(stripe, next(iter(stripe.entries)), 'evictions')
+
+    __setitem__ = set
+
+    def pop(self, k, *default):
+        stripe = self._stripe(k)
+        with stripe.lock:
+            entry = stripe.entries.get(k)
+            if entry is not None:
+                self._drop(stripe, k)
+                if entry[1] is None or time.time() < entry[1]:
+                    return entry[0]
+        if default:
+            return default[0]
+        raise KeyError(k)
+
     def __delitem__(self, k):
-        dict.__delitem__(self, k)
-        self._exp.pop(k, None)
+        stripe = self._stripe(k)
+        with stripe.lock:
+            if k not in stripe.entries:
+                raise KeyError(k)
+            self._drop(stripe, k)
+
+    def __iter__(self):
+        now = time.time()
+        keys = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                keys.extend(k for k, entry in stripe.entries.items()
+                            if entry[1] is None or now < entry[1])
+        return iter(keys)
+
+    def __len__(self):
+        now = time.time()
+        count = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                count += sum(1 for entry in stripe.entries.values()
+                             if entry[1] is None or now < entry[1])
+        return count
+
+    def clear(self):
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.entries.clear()
+                del stripe.heap[:]
+                stripe.bytes = 0
+
+    @property
+    def stats(self):
+        stats = collections.Counter()
+        for stripe in self._stripes:
+            stats.update(stripe.stats)
+        stats['entries'] = len(self)
+        stats['bytes'] = sum(stripe.bytes for stripe in self._stripes)
+        return stats
 
     def __repr__(self):
-        return "%s(%s, timeout=%r)" % (
+        return "%s(%r, timeout=%r, max_entries=%r, max_bytes=%r)" % (
             self.__class__.__name__,
-            dict.__repr__(self),
-            self.timeout)
+            dict((k, self.get(k)) for k in self),
+            self.timeout,
+            self.max_entries,
+            self.max_bytes)
 
 
 class Encoder(JSONEncoder):
-    def default(self, obj):
+    # Serializers are looked up by exact type, and resolved once per type
+    # (through the MRO, then by probing) so encoding does no
+    # exception-driven dispatch.
+    _serializers = {}
+
+    @classmethod
+    def register(cls, type, func):
+        cls._serializers[type] = func
+        # Subclasses may have been resolved through a previous registration.
+        for t in list(cls._serializers):
+            if t is not type and issubclass(t, type):
+                del cls._serializers[t]
+
+    def _resolve(self, obj):
         from .models import dump
+
+        t = type(obj)
+        for base in t.__mro__[1:]:
+            func = self._serializers.get(base)
+            if func is not None:
+                return func
         try:
-            return dump(obj)
+            dump(obj)
         except TypeError:
             pass
-        try:
-            return obj.dump()
-        except AttributeError:
-            pass
-        try:
-            return list(obj)
-        except TypeError:
-             pass
-        return super(Encoder, self).default(obj)
-        
+        else:
+            return dump
+        if callable(getattr(t, 'dump', None)):
+            return _dump_method
+        if hasattr(t, '__iter__'):
+            return list
+        return None
+
+    def default(self, obj):
+        t = type(obj)
+        func = self._serializers.get(t)
+        if func is None:
+            func = self._resolve(obj)
+            if func is None:
+                return super(Encoder, self).default(obj)
+            self._serializers[t] = func
+        return func(obj)
+
+
+_dump_method = operator.methodcaller('dump')
+
+encode = Encoder(separators=(',', ':')).encode
@@ -1,9 +1,19 @@
 from django.contrib.auth import REDIRECT_FIELD_NAME
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotAllowed
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotAllowed, \
+    HttpResponseForbidden, HttpResponseBadRequest
+try:
+    from django.http import StreamingHttpResponse
+except ImportError: # before Django 1.5, HttpResponse streams iterators itself
+    StreamingHttpResponse = HttpResponse
 
 from .services import commit_logout as commit_service_logout, get_logout_urls, \
     is_logged_out, get_service, LOGIN_SERVICE_KEY
-from .utils import Encoder, same_origin_redirect, invalid_csrf_token
+from .models import conf, User
+from .utils import encode, same_origin_redirect, invalid_csrf_token, on_app_engine
+
+
+PAGE_SIZE = conf.get('PAGE_SIZE') # None pages only when asked to, with limit or cursor
+MAX_PAGE_SIZE = conf.get('MAX_PAGE_SIZE', 1000)
 
 
 _MESSAGE_KEY = 'message'
@@ -12,7 +22,7 @@ ERROR = {_MESSAGE_KEY: 'error'}
 
 
 def _message(type, data=None):
-    return HttpResponse(Encoder.encode(dict(type, data=data)))
+    return HttpResponse(encode(dict(type, data=data)))
 
 
 # TODO: Oauth token will be handled by a middleware and
@@ -42,13 +52,43 @@ def form_post(request, form, takes_request=False, commit=True, **kwargs):
 form = form_post
 
 
-def model(request, getter, params=(), **kwargs):
+def _stream_page(items, cursor):
+    # Items are encoded one at a time, so only their encoding is streamed.
+    yield '{"items":['
+    for i, item in enumerate(items):
+        yield (',' if i else '') + encode(item)
+    yield '],"cursor":%s}' % encode(cursor)
+
+
+def model(request, getter, params=(), page_size=PAGE_SIZE, **kwargs):
+    '''
+    Query results are returned whole, as a list, unless a "limit" or
+    "cursor" is passed, or page_size is set. Then they are returned a page
+    at a time, as {"items": [...], "cursor": ...}. Pass the cursor back,
+    with an optional "limit" up to MAX_PAGE_SIZE, to get the next page; it
+    is null on the last one.
+    '''
     if request.method != "GET":
         return HttpResponseNotAllowed(['GET'])
 
     kwargs.update({k:request.GET[k] for k in params if k in request.GET})
     m = getter(**kwargs) #TODO: add some 40x errors
-    return HttpResponse(Encoder.encode(m))
+    paged = page_size or 'limit' in request.GET or 'cursor' in request.GET
+    if not (paged and hasattr(m, 'with_cursor')):
+        return HttpResponse(encode(m))
+
+    try:
+        limit = min(int(request.GET.get('limit', page_size or MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError(limit)
+        if request.GET.get('cursor'):
+            m.with_cursor(request.GET['cursor'])
+    except Exception: # datastore cursor errors aren't ValueErrors
+        return HttpResponseBadRequest()
+    # Fetched here, so that datastore errors aren't raised mid-response.
+    items = m.fetch(limit)
+    cursor = m.cursor() if len(items) == limit else None
+    return StreamingHttpResponse(_stream_page(items, cursor), content_type='application/json')
 
 
 def service_callback(request, service_name, next_page=None):
@@ -68,11 +108,15 @@ def service_callback(request, service_name, next_page=None):
         # service for logging in the future.
         return response 
     ext = authenticate(service=service) # Always returns a user
-    user = User.fetch_by_alias(ext.id)
+    # Both lookups are started together, though the second one is only
+    # needed if the first finds nothing.
+    by_alias = User.fetch_by_alias_async(ext.id)
+    by_email = ext.is_validated and User.fetch_by_email_async(ext.email)
+    user = by_alias.get_result()
     # An aliased user is found when someone logs in externally
     # *for the second time* with the same service.
-    if not user and ext.is_validated:
-        user = User.fetch_by_email(ext.email)
+    if not user and by_email:
+        user = by_email.get_result()
         if user:
             user.aliased_to = ext.id
         # The new User entity still needs to be validated, but shortcut validation 
@@ -92,7 +136,7 @@ def logout(request, next_page=None, redirect_field_name=REDIRECT_FIELD_NAME):
     # Handle ?next=... e.g. in case this is used as part of an OAuth service.
     # Don't use next if there is a csrf_token.
     response = (invalid_csrf_token(request, csrf_token) 
-                or same_origin_redirect(request, request.GET.get(redirect_field_name))
+                or same_origin_redirect(request, request.GET.get(redirect_field_name)))
     if response:
         return response
 
@@ -120,3 +164,53 @@ def commit_logout(request, service_name=None):
         logout(request)
         lo = True
     return _message(SUCCESS, {'logged_out': lo})
+
+
+def availability(request):
+    '''
+    Answers as-you-type checks of ?username= and ?email=, e.g.
+    {"username": true} if the username is taken. Likely free names are
+    answered from the availability filter alone, so the answer is only a
+    hint; the signup form looks up again.
+    '''
+    from .availability import username_may_be_taken, email_may_be_taken
+
+    if request.method != "GET":
+        return HttpResponseNotAllowed(['GET'])
+
+    r = {}
+    username = request.GET.get('username', '').lower()
+    if username:
+        r['username'] = bool(username_may_be_taken(username)
+                             and User.fetch(username))
+    email = request.GET.get('email', '').strip().lower()
+    if email:
+        r['email'] = bool(email_may_be_taken(email)
+                          and User.fetch_by_email(email))
+    return _message(SUCCESS, r)
+
+
+def _cron_or_staff(request):
+    # App Engine marks its cron requests with a header, which it strips
+    # from any other request. Elsewhere, anyone can send it.
+    return ((on_app_engine() and request.META.get('HTTP_X_APPENGINE_CRON'))
+            or request.user.is_staff)
+
+
+def purge_sessions(request, batch_size=500, deadline=50):
+    from .session_backend import purge_expired
+
+    # Meant to be run by cron. ?scan=1 also finds sessions saved before
+    # expire_date was indexed.
+    if not _cron_or_staff(request):
+        return HttpResponseForbidden()
+    return _message(SUCCESS, purge_expired(batch_size, deadline, request.GET.get('cursor'),
+                                           scan=bool(request.GET.get('scan'))))
+
+
+def rebuild_availability(request):
+    from .availability import taken
+
+    if not _cron_or_staff(request):
+        return HttpResponseForbidden()
+    return _message(SUCCESS, taken.rebuild())